@@ -1,12 +1,24 @@
+import logging
 import os
+from pathlib import Path
 import dotenv
 
 dotenv.load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 DATABASE_URL = os.getenv("DATABASE_URL", "No key found")
-print(DATABASE_URL)
+# Logs every SQL statement, for debugging only
+SQL_ECHO = os.getenv("SQL_ECHO", "").lower() in ("1", "true", "yes")
 
 FRONTEND_URL = os.getenv("FRONTEND_URL", "http://localhost:5173")
-print(FRONTEND_URL)
+logger.debug("FRONTEND_URL=%s", FRONTEND_URL)
+
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "No key found")
+
+EMBEDDING_CONCURRENCY = int(os.getenv("EMBEDDING_CONCURRENCY", "5"))
+
+TTS_CONCURRENCY = int(os.getenv("TTS_CONCURRENCY", "4"))
 
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "No key found")
\ No newline at end of file
+TTS_CACHE_DIR = Path(os.getenv("TTS_CACHE_DIR", "tts_cache"))
+TTS_CACHE_MAX_BYTES = int(os.getenv("TTS_CACHE_MAX_BYTES", str(2 * 1024 ** 3)))
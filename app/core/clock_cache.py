@@ -0,0 +1,48 @@
+from collections import deque
+from typing import Any, Hashable, Optional
+
+# CLOCK approximation of LRU. A hit only flips the entry's referenced bit, nothing is relinked,
+# so lookups from many concurrent listeners never reorder shared state. Eviction sweeps the ring,
+# giving referenced entries a second chance before dropping the first unreferenced one.
+class ClockCache:
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._entries: dict[Hashable, list] = {}  # key -> [value, referenced]
+        self._ring = deque()  # Keys in sweep order, the hand is at the left
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def peek(self, key: Hashable, default: Optional[Any] = None) -> Optional[Any]:
+        """Returns the value without counting it as a use"""
+        entry = self._entries.get(key)
+        return entry[0] if entry is not None else default
+
+    def get(self, key: Hashable, default: Optional[Any] = None) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+        entry[1] = True
+        return entry[0]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        entry = self._entries.get(key)
+        if entry is not None:
+            entry[0] = value
+            entry[1] = True
+            return
+
+        while len(self._entries) >= self.capacity:
+            hand = self._ring[0]
+            if self._entries[hand][1]:
+                self._entries[hand][1] = False
+                self._ring.rotate(-1)
+            else:
+                self._ring.popleft()
+                del self._entries[hand]
+
+        self._entries[key] = [value, True]
+        self._ring.append(key)
@@ -0,0 +1,43 @@
+import hashlib
+import zlib
+from typing import List
+import numpy as np
+
+# MinHash over 5-word shingles, for spotting uploads that are near-copies of a book we already have
+# (re-exports, re-scans with a fixed cover page) rather than byte-identical files.
+NUM_PERM = 128
+LSH_BANDS = 16  # 16 bands of 8 rows, candidates from about 0.7 Jaccard, confirmed against the full signature
+SHINGLE_SIZE = 5
+_PRIME = (1 << 31) - 1  # a * crc32 + b stays below 2**64
+
+# Fixed seed, signatures have to stay comparable across worker processes and restarts
+_rng = np.random.default_rng(20240601)
+_A = _rng.integers(1, _PRIME, NUM_PERM, dtype=np.uint64)
+_B = _rng.integers(0, _PRIME, NUM_PERM, dtype=np.uint64)
+
+def empty_signature() -> np.ndarray:
+    return np.full(NUM_PERM, _PRIME, dtype=np.uint64)
+
+def update_signature(signature: np.ndarray, text: str) -> None:
+    """Folds the shingles of text into signature in place"""
+    words = text.split()
+    if not words:
+        return
+    shingles = {" ".join(words[i:i + SHINGLE_SIZE]) for i in range(max(1, len(words) - SHINGLE_SIZE + 1))}
+    hashes = np.fromiter((zlib.crc32(shingle.encode()) for shingle in shingles), dtype=np.uint64, count=len(shingles))
+    # Every permutation of every shingle in one broadcast, then the per-permutation minimum
+    np.minimum(signature, ((hashes[:, None] * _A + _B) % _PRIME).min(axis=0), out=signature)
+
+def is_empty(signature: np.ndarray) -> bool:
+    """True when no text was folded in, such signatures would match every other empty one"""
+    return bool((signature == _PRIME).all())
+
+def band_keys(signature: np.ndarray) -> List[bytes]:
+    """One key per LSH band, books sharing any key are near-duplicate candidates"""
+    return [
+        hashlib.blake2b(band.tobytes(), digest_size=8).digest()
+        for band in np.split(signature, LSH_BANDS)
+    ]
+
+def jaccard(signature: np.ndarray, other: np.ndarray) -> float:
+    return float(np.mean(signature == other))
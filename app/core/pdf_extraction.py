@@ -0,0 +1,46 @@
+from typing import Dict, List, Tuple
+import numpy as np
+from PyPDF2 import PdfReader
+
+from app.core.minhash import empty_signature, update_signature
+
+# Runs inside worker processes, so keep this module's imports light: a spawned worker
+# imports it fresh and shouldn't drag in the database or embedding setup.
+def read_outline(file_path: str) -> Tuple[Dict, int]:
+    """Returns the PDF's table of contents and page count, without extracting any text"""
+    reader = PdfReader(file_path)
+    return create_table_of_contents(reader), len(reader.pages)
+
+def extract_pages_text(file_path: str, start: int, stop: int) -> Tuple[List[str], np.ndarray]:
+    """Extracts the text of pages [start, stop), one shard of the book per worker,
+    along with the shard's MinHash signature so hashing the text stays off the server process"""
+    reader = PdfReader(file_path)
+    pages = [reader.pages[i].extract_text() for i in range(start, stop)]
+    signature = empty_signature()
+    for page in pages:
+        update_signature(signature, page)
+    return pages, signature
+
+def create_table_of_contents(reader: PdfReader) -> Dict:
+    toc = {}
+    if not reader.outline:
+        return toc
+
+    # Depth-first over the outline with a stack of iterators rather than recursion. Nested lists
+    # are sub-chapters (like in Great Gatsby), entries are keyed in reading order so they can't collide.
+    # Page numbers are resolved here, once per upload, and are 0-based like Page.page_number
+    stack = [iter(reader.outline)]
+    while stack:
+        item = next(stack[-1], None)
+        if item is None:
+            stack.pop()
+        elif isinstance(item, list):
+            stack.append(iter(item))
+        elif isinstance(item, dict):
+            toc[str(len(toc))] = {
+                'title': item.get('/Title', ''),
+                'page_number': max(reader.get_destination_page_number(item) or 0, 0),  # -1 or None when unresolvable
+                'timestamp': 0.0
+            }
+
+    return toc
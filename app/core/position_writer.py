@@ -0,0 +1,66 @@
+import asyncio
+import logging
+from contextlib import suppress
+from typing import Dict, Optional, Tuple
+
+from app.db.database import update_reading_positions
+
+logger = logging.getLogger(__name__)
+
+POSITION_FLUSH_INTERVAL = 0.25  # Seconds of position updates that can be lost on a crash
+
+# Narrating clients report positions several times a second and only the latest one per reader and
+# book matters, so updates are buffered here and written together once per interval rather than
+# one UPDATE per request. Everything runs on the event loop, so swapping the buffer needs no lock.
+class PositionWriter:
+    def __init__(self, interval: float = POSITION_FLUSH_INTERVAL):
+        self.interval = interval
+        self._pending: Dict[Tuple[str, str], dict] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def set(self, user_id: str, book_id: str, position: dict) -> None:
+        self._pending[(user_id, book_id)] = position
+
+    def get(self, user_id: str, book_id: str) -> Optional[dict]:
+        """The position still waiting to be written, if any, newer than the stored one"""
+        return self._pending.get((user_id, book_id))
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            task, self._task = self._task, None
+            task.cancel()
+            # Let a flush caught mid-write put its positions back before the final flush
+            with suppress(asyncio.CancelledError):
+                await task
+        await self.flush()
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Writing reading positions failed, retrying")
+
+    async def flush(self) -> None:
+        pending, self._pending = self._pending, {}
+        try:
+            await update_reading_positions(pending)
+        except BaseException:
+            # Put back for the next flush, unless a newer position has arrived meanwhile.
+            # BaseException so a flush cancelled by stop() doesn't drop what it swapped out
+            for key, position in pending.items():
+                self._pending.setdefault(key, position)
+            raise
+
+_position_writer = None
+
+def get_position_writer() -> PositionWriter:
+    global _position_writer
+    if _position_writer is None:
+        _position_writer = PositionWriter()
+    return _position_writer
@@ -1,16 +1,51 @@
 from abc import ABC, abstractmethod
-import os
+import asyncio
+from bisect import bisect_right
+from contextlib import aclosing
+import logging
+from collections import OrderedDict, deque
+from functools import lru_cache
+from itertools import chain
 import re
-from openai import OpenAI
+import threading
+from typing import AsyncIterator, Awaitable, Callable, Optional
 from sqlalchemy import select, and_
-from sqlalchemy.ext.asyncio import AsyncSession
-from app.db.database import get_async_db, get_audio_chunk_for_timestamp
-from app.models.models import Page
+from app.config import TTS_CACHE_DIR, TTS_CACHE_MAX_BYTES, TTS_CONCURRENCY
+from app.core.clock_cache import ClockCache
+from app.core.tts_cache import TTSDiskCache
+from app.db.database import get_async_db, get_audio_chunk_bounds
+from app.models.models import AudioChunk, Page
+from app.services.openai_client import get_async_openai_client
+
+logger = logging.getLogger(__name__)
+
+# Sentence-ending punctuation followed by whitespace or the end of the text, except after an ellipsis
+_SENTENCE_END_RE = re.compile(r'([.!?]+)(?<!\.\.\.)(?:\s+|$)')
+
+# Memoized since the same paragraph is re-split whenever its page is re-synthesized
+# (retries, another voice, prefetch racing playback)
+@lru_cache(maxsize=256)
+def _sentences_for(text: str) -> tuple[str, ...]:
+    # Single pass over the text, slicing sentences out at each boundary: 'Hi! What!? Name.' -> ['Hi!', 'What!?', 'Name.']
+    sentences = []
+    start = 0
+    for match in _SENTENCE_END_RE.finditer(text):
+        sentences.append(text[start:match.end(1)])
+        start = match.end()
+    if tail := text[start:].rstrip():
+        sentences.append(tail)
+    # If the last sentence doesn't end with a period, add one
+    if sentences and sentences[-1][-1] not in '.!?':
+        sentences[-1] = sentences[-1] + '.'
+    return tuple(sentences)
+
+# Shared across transcribers so concurrent pages together stay under OpenAI's rate limits
+_tts_semaphore = asyncio.Semaphore(TTS_CONCURRENCY)
 
 # Creating voices, synthesizing audio, diarization all done here.
 class SynthTranscriber(ABC):
     @abstractmethod
-    def synthesize_audio(self, page: Page) -> bytes:
+    async def synthesize_page_audio(self, page: Page) -> bytes:
         pass
 
 # Actually managing the cursor position and plyaback interactions between
@@ -18,11 +53,18 @@ class SynthTranscriber(ABC):
 
 ### Important question to answer is whether pages are first class citizens or not
 class Narrator(ABC):
-    def __init__(self):
-        self.audio_buffer = {}  # Map of chunk sequence numbers to audio bytes
+    def __init__(self, book_id: str):
+        self.book_id = book_id
+        self.buffer_size = 2  # Number of chunks to buffer ahead
+        self.buffer_behind = 1  # Number of chunks kept behind for short rewinds
+        # Bounded, keyed by integer chunk sequence number: the chunks behind, the current one and the ones ahead
+        self.audio_buffer = ClockCache(self.buffer_behind + 1 + self.buffer_size)
         self.current_chunk = None
         self.current_position = 0
-        self.buffer_size = 2  # Number of chunks to buffer ahead
+        self._prefetch_tasks: dict[int, asyncio.Task] = {}  # In-flight prefetches by sequence number
+        # Timestamp index of the book's chunks, loaded once so seeking is a bisect instead of a query
+        self._chunk_starts: Optional[list[float]] = None
+        self._chunk_bounds: list[tuple[float, int]] = []  # (end_timestamp, sequence_number), same order
 
     @abstractmethod
     def narrate(self, current_position: float) -> str:
@@ -32,45 +74,92 @@ class Narrator(ABC):
     def interrupt(self, current_position: float) -> None:
         pass
 
+    async def _load_chunk_index(self) -> None:
+        bounds = await get_audio_chunk_bounds(self.book_id)
+        self._chunk_starts = [start for start, _, _ in bounds]
+        self._chunk_bounds = [(end, sequence_number) for _, end, sequence_number in bounds]
+
+    def invalidate_chunk_index(self) -> None:
+        """Call when the book's audio chunks change, the index is reloaded on the next lookup"""
+        self._chunk_starts = None
+
+    def _bisect_chunk(self, timestamp: float) -> Optional[int]:
+        i = bisect_right(self._chunk_starts, timestamp) - 1
+        if i >= 0 and timestamp < self._chunk_bounds[i][0]:
+            return self._chunk_bounds[i][1]
+        return None
+
+    async def _locate_chunk(self, timestamp: float) -> Optional[int]:
+        """Returns the sequence number of the chunk playing at timestamp"""
+        if self._chunk_starts is None:
+            await self._load_chunk_index()
+            return self._bisect_chunk(timestamp)
+        sequence_number = self._bisect_chunk(timestamp)
+        if sequence_number is None:
+            # Audio may have been synthesized past the end of the index since it was loaded
+            await self._load_chunk_index()
+            sequence_number = self._bisect_chunk(timestamp)
+        return sequence_number
+
+    async def _fetch_chunks(self, sequence_numbers: list[int]) -> None:
+        try:
+            async with get_async_db() as db:
+                # Only what playback reads, plain rows instead of tracked ORM objects
+                result = await db.execute(
+                    select(
+                        AudioChunk.sequence_number,
+                        AudioChunk.start_timestamp,
+                        AudioChunk.end_timestamp,
+                        AudioChunk.audio_blob
+                    )
+                    .where(
+                        and_(
+                            AudioChunk.book_id == self.book_id,
+                            AudioChunk.sequence_number.in_(sequence_numbers)
+                        )
+                    )
+                )
+                for next_chunk in result:
+                    self.audio_buffer.put(next_chunk.sequence_number, next_chunk)
+        finally:
+            for sequence_number in sequence_numbers:
+                self._prefetch_tasks.pop(sequence_number, None)
+
+    def _prefetch_after(self, sequence_number: int) -> None:
+        """Kicks off a background load for the chunks after sequence_number so the next
+        request is served from the buffer instead of waiting on the database"""
+        wanted = [
+            sequence_number + i for i in range(1, self.buffer_size + 1)
+            if sequence_number + i not in self.audio_buffer
+            and sequence_number + i not in self._prefetch_tasks
+        ]
+        if not wanted:
+            return
+        # One IN (...) query for the whole window rather than a round-trip per chunk
+        task = asyncio.create_task(self._fetch_chunks(wanted))
+        for next_sequence in wanted:
+            self._prefetch_tasks[next_sequence] = task
+
     async def load_audio(self, timestamp: float) -> bytes:
         """Loads audio chunk for given timestamp and manages buffer"""
-        async with get_async_db() as db:
-            chunk, position = await get_audio_chunk_for_timestamp(db, self.book_id, timestamp)
-            
-            if not chunk:
+        sequence_number = await self._locate_chunk(timestamp)
+        if sequence_number is None:
+            raise ValueError("No audio chunk found for timestamp")
+
+        chunk = self.audio_buffer.get(sequence_number)
+        if chunk is None:
+            # Most likely already on its way from a prefetch, otherwise load just this one
+            task = self._prefetch_tasks.get(sequence_number)
+            await (task if task is not None else self._fetch_chunks([sequence_number]))
+            chunk = self.audio_buffer.get(sequence_number)
+            if chunk is None:
                 raise ValueError("No audio chunk found for timestamp")
-                
-            if chunk.sequence_number not in self.audio_buffer:
-                # Load requested chunk
-                self.audio_buffer[chunk.sequence_number] = chunk.audio_blob
-                
-                # Pre-fetch next chunks
-                for i in range(1, self.buffer_size + 1):
-                    next_chunk = await db.execute(
-                        select(AudioChunk)
-                        .where(
-                            and_(
-                                AudioChunk.book_id == self.book_id,
-                                AudioChunk.sequence_number == chunk.sequence_number + i
-                            )
-                        )
-                    )
-                    next_chunk = next_chunk.scalar_one_or_none()
-                    if next_chunk:
-                        self.audio_buffer[next_chunk.sequence_number] = next_chunk.audio_blob
-                        
-                # Remove old chunks from buffer
-                keys_to_remove = [
-                    k for k in self.audio_buffer.keys() 
-                    if k < chunk.sequence_number - 1
-                ]
-                for k in keys_to_remove:
-                    del self.audio_buffer[k]
-            
-            self.current_chunk = chunk
-            self.current_position = position
-            
-            return self.audio_buffer[chunk.sequence_number]
+
+        self.current_chunk = chunk
+        self.current_position = timestamp - chunk.start_timestamp
+        self._prefetch_after(chunk.sequence_number)
+
+        return chunk.audio_blob
 
     @abstractmethod
     def _go_to_nearest_sentence(self, current_position: float) -> None:
@@ -105,22 +194,19 @@ class Narrator(ABC):
 # Licensing out human audio would still be the recommended byte source.
 class OpenAISynthTranscriber(SynthTranscriber):
     def __init__(self):
-        self.client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+        self.client = get_async_openai_client()
         self.MAX_CHARS = 4096
+        self.TTS_MODEL = "tts-1"
+        # Opus is typically 30-50% smaller than the default MP3 at the same quality
+        self.TTS_FORMAT = "opus"
+        self.CONTENT_TYPE = "audio/ogg; codecs=opus"
+        self.STREAM_CHUNK_SIZE = 8192
+        self.cache = TTSDiskCache(TTS_CACHE_DIR, TTS_CACHE_MAX_BYTES)
+        self._page_tasks: dict[str, asyncio.Task] = {}  # In-flight page syntheses by page id, until they finish
 
-    def _break_into_sentences(self, text: str) -> list[str]:
-        text = text.replace('...', '###ELLIPSIS###')
-
-        sentences = re.split(r'([.!?]+)\s+', text)
-        # Recombine delimiter with sentence: ['Hi', '!', 'What', '!?', 'Name', '.'] -> ['Hi!', 'What!?', 'Name.']
-        sentences = [''.join(sentences[i:i+2]) for i in range(0, len(sentences)-1, 2)]
-        # If the last sentence doesn't end with a period, add one
-        if sentences and sentences[-1][-1] not in '.!?':
-            sentences[-1] = sentences[-1] + '.'
+    def _break_into_sentences(self, text: str) -> tuple[str, ...]:
+        return _sentences_for(text)
 
-        sentences = [s.replace('###ELLIPSIS###', '...') for s in sentences]
-        return sentences
-    
     def _convert_paragraph_text_to_buffers(self, paragraphed_text: list[str]) -> list[str]:
         """Converts paragraphed text into buffers that are under MAX_CHARS in length.
         Processing order:
@@ -129,62 +215,68 @@ class OpenAISynthTranscriber(SynthTranscriber):
         3. If space still remains, fits individual words
         Any remaining text is added back to the start of the paragraph list for next iteration"""
         def flush_buffer() -> None:
-            nonlocal current_buffer, sized_buffers
-            if current_buffer.strip():
-                sized_buffers.append(current_buffer.strip())
-                current_buffer = ""
+            nonlocal current_length
+            text = "".join(current_buffer).strip()
+            if text:
+                sized_buffers.append(text)
+            current_buffer.clear()
+            current_length = 0
+
+        def append_to_buffer(text: str) -> None:
+            nonlocal current_length
+            current_buffer.append(text)
+            current_length += len(text)
 
-        def process_sentences(current_buffer: str, paragraph_chunk: str) -> tuple[bool, list[str]]:
+        def process_sentences(paragraph_chunk: str) -> tuple[bool, tuple[str, ...]]:
+            # Walk the memoized sentences by index, only the unfitted tail is sliced off
             sentences = self._break_into_sentences(paragraph_chunk)
-            did_any_fit = False
-            while sentences:
-                sentence = sentences.pop(0)
-                if len(current_buffer + sentence + "\n") <= self.MAX_CHARS:
-                    current_buffer += sentence + "\n"
-                    did_any_fit = True
-                else:
-                    sentences.insert(0, sentence)
-                    break
-            return did_any_fit, current_buffer, sentences
-        
-
-        def process_words(current_buffer: str, sentences: list[str]) -> tuple[str, list[str]]:
-            words = sentences.pop(0).split(' ')
-            while words:
-                word = words.pop(0)
-                if len(current_buffer + word + " ") <= self.MAX_CHARS:
-                    current_buffer += word + " "
-                else:
-                    words.insert(0, word)
-                    break
-            sentences.insert(0, " ".join(words))
-            return current_buffer, sentences
-        
+            i = 0
+            while i < len(sentences) and current_length + len(sentences[i]) + 1 <= self.MAX_CHARS:
+                append_to_buffer(sentences[i] + "\n")
+                i += 1
+            return i > 0, sentences[i:]
+
+
+        def process_words(sentence: str) -> str:
+            # Cut at the last space that still fits instead of moving word by word,
+            # one C-level scan and two slices regardless of how many words fit
+            room = self.MAX_CHARS - current_length
+            if len(sentence) + 1 <= room:
+                append_to_buffer(sentence + " ")
+                return ""
+            cut = sentence.rfind(' ', 0, room)
+            if cut >= 0:
+                append_to_buffer(sentence[:cut + 1])
+            return sentence[cut + 1:]
+
 
         sized_buffers = []
-        current_buffer = ""
-        unprocessed_chunks = paragraphed_text
-        print("\033[95mTotal paragraphs:", len(paragraphed_text))
-        for i, p in enumerate(paragraphed_text):
-            print(f"Paragraph {i} length:", len(p), "\033[0m")
+        current_buffer = []  # Fragments of the buffer being built, joined once on flush
+        current_length = 0
+        unprocessed_chunks = deque(paragraphed_text)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Total paragraphs: %d", len(paragraphed_text))
+            for i, p in enumerate(paragraphed_text):
+                logger.debug("Paragraph %d length: %d", i, len(p))
 
         # Process paragraphs
         while unprocessed_chunks:
             paragraph_processed = False
-            # At this point, optimistically processing paragraphs
-            while unprocessed_chunks and len(current_buffer + (chunk:=unprocessed_chunks.pop(0)) + "\n") <= self.MAX_CHARS:
-                current_buffer += chunk + "\n"
+            # At this point, optimistically processing paragraphs, measured before they are taken off the queue
+            while unprocessed_chunks and current_length + len(unprocessed_chunks[0]) + 1 <= self.MAX_CHARS:
+                append_to_buffer(unprocessed_chunks.popleft() + "\n")
                 paragraph_processed = True
 
-            if not paragraph_processed:
+            # A paragraph that didn't fit after others were buffered simply starts the next buffer
+            if unprocessed_chunks and not paragraph_processed:
                 # process the paragragh as sentences if > max_chars
-                did_any_sentences_fit, current_buffer, sentences = process_sentences(current_buffer, chunk)
+                did_any_sentences_fit, sentences = process_sentences(unprocessed_chunks.popleft())
 
                 # process the sentence as words if > max_chars:
                 if sentences and not did_any_sentences_fit:
-                    current_buffer, sentences = process_words(current_buffer, sentences)
-                    remainder = " ".join(sentences)
-                    unprocessed_chunks.insert(0, remainder)
+                    sentences = (process_words(sentences[0]), *sentences[1:])
+                if sentences:
+                    unprocessed_chunks.appendleft(" ".join(sentences))
 
             flush_buffer()
 
@@ -192,17 +284,137 @@ class OpenAISynthTranscriber(SynthTranscriber):
         return sized_buffers if sized_buffers else [""]
 
     def _convert_page_to_buffered_text(self, page: Page) -> list[str]:
-        unprocessed_chunks = page.paragraphed_text[::-1]
-        return self._convert_paragraph_text_to_buffers(unprocessed_chunks)
-
-    def _convert_text_to_audio(self, text: str, voice: str = "alloy") -> bytes:
-        response = self.client.audio.speech.create(
-            model="tts-1",
-            input=text,
-            voice=voice
-        )
-        return response.content
-        
-    def synthesize_audio(self, page: Page):
-        text = self._convert_page_to_text(page)
-        return self._convert_text_to_audio(text)
+        return self._convert_paragraph_text_to_buffers(page.paragraphed_text)
+
+    async def _stream_text_to_audio(self, text: str, voice: str = "alloy") -> AsyncIterator[bytes]:
+        """Yields audio bytes as they arrive from OpenAI instead of waiting for the whole file"""
+        key = TTSDiskCache.make_key(text, voice, self.TTS_MODEL, self.TTS_FORMAT)
+        cached = await asyncio.to_thread(self.cache.get, key)
+        if cached is not None:
+            yield cached
+            return
+
+        # The request runs in a task of its own that holds the TTS slot only as long as OpenAI takes,
+        # however slowly the audio is consumed. Unbounded, the whole audio is kept for the cache anyway
+        chunks = asyncio.Queue()
+        request = asyncio.create_task(self._fetch_audio(text, voice, key, chunks))
+        try:
+            while (chunk := await chunks.get()) is not None:
+                yield chunk
+            await request  # Raises whatever cut the audio short
+        finally:
+            request.cancel()
+            await asyncio.gather(request, return_exceptions=True)
+
+    async def _fetch_audio(self, text: str, voice: str, key: str, chunks: asyncio.Queue) -> None:
+        """Puts the audio's chunks on the queue as they arrive, then None, and caches the whole audio"""
+        try:
+            audio = bytearray()  # Copy kept for the cache, grown in place
+            async with _tts_semaphore:
+                async with self.client.audio.speech.with_streaming_response.create(
+                    model=self.TTS_MODEL,
+                    input=text,
+                    voice=voice,
+                    response_format=self.TTS_FORMAT
+                ) as response:
+                    async for chunk in response.iter_bytes(self.STREAM_CHUNK_SIZE):
+                        audio.extend(chunk)
+                        chunks.put_nowait(chunk)
+            await asyncio.to_thread(self.cache.put, key, audio)
+        finally:
+            chunks.put_nowait(None)
+
+    async def _collect_audio_chunks(self, text: str, voice: str = "alloy") -> list[bytes]:
+        async with aclosing(self._stream_text_to_audio(text, voice)) as stream:
+            return [chunk async for chunk in stream]
+
+    async def _convert_text_to_audio(self, text: str, voice: str = "alloy") -> bytes:
+        return b"".join(await self._collect_audio_chunks(text, voice))
+
+    async def synthesize_page_audio(self, page: Page) -> bytes:
+        """Synthesizes every buffer of the page concurrently and joins the audio in page order"""
+        buffers = await asyncio.to_thread(self._convert_page_to_buffered_text, page)
+        # A failed buffer cancels its siblings instead of letting them finish paid requests for a page we drop
+        try:
+            async with asyncio.TaskGroup() as group:
+                tasks = [group.create_task(self._collect_audio_chunks(buffer)) for buffer in buffers]
+        except* Exception as failures:
+            # Callers see the first buffer's error itself (an openai.APIError...), not an ExceptionGroup
+            raise failures.exceptions[0]
+        # Single allocation for the whole page rather than one per buffer plus one for the page
+        return b"".join(chain.from_iterable(task.result() for task in tasks))
+
+    async def stream_page_audio(self, page: Page) -> AsyncIterator[bytes]:
+        """Like synthesize_page_audio, but yields audio in page order as soon as it is ready, so
+        playback can start before the whole page is synthesized. The first buffer is streamed
+        straight from OpenAI while the rest are synthesized concurrently in the background"""
+        first_buffer, *buffers = await asyncio.to_thread(self._convert_page_to_buffered_text, page)
+        tasks = []
+        try:
+            async with aclosing(self._stream_text_to_audio(first_buffer)) as stream:
+                async for chunk in stream:
+                    # The rest start once the first buffer has its first chunk, so they never take
+                    # the TTS slot the first buffer (time to first audio) is waiting on
+                    if not tasks:
+                        tasks = [asyncio.create_task(self._convert_text_to_audio(buffer)) for buffer in buffers]
+                    yield chunk
+            if not tasks:
+                tasks = [asyncio.create_task(self._convert_text_to_audio(buffer)) for buffer in buffers]
+            for task in tasks:
+                yield await task
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)  # Retrieves failures, nothing logs them as lost
+
+    async def write_page_audio(self, page: Page, write: Callable[[bytes], Awaitable[None]]) -> int:
+        """Streams the page's audio into an async writer (a file, a large object, a multipart
+        upload) in page order, so the whole page never has to be joined in memory.
+        Returns the number of bytes written"""
+        written = 0
+        async with aclosing(self.stream_page_audio(page)) as stream:
+            async for chunk in stream:
+                await write(chunk)
+                written += len(chunk)
+        return written
+
+    def prefetch_page(self, page: Page) -> asyncio.Task:
+        """Starts synthesizing a page in the background, e.g. the next page while the current one
+        plays. Callers asking for a page that is already in flight share the same task"""
+        task = self._page_tasks.get(page.id)
+        if task is None:
+            task = asyncio.create_task(self.synthesize_page_audio(page))
+            # Held here strongly, the event loop only keeps a weak reference to a fire-and-forget prefetch
+            self._page_tasks[page.id] = task
+            task.add_done_callback(lambda _: self._page_tasks.pop(page.id, None))
+        return task
+
+# Singleton instance
+_synth = None
+_synth_lock = threading.Lock()
+
+def get_synth() -> OpenAISynthTranscriber:
+    global _synth
+    if _synth is None:
+        with _synth_lock:
+            if _synth is None:
+                _synth = OpenAISynthTranscriber()
+    return _synth
+
+# Narrators are kept per book so each reader's buffered and prefetched audio survives
+# requests for other books, least recently used books are dropped past the cap
+MAX_BOOKS_IN_MEMORY = 32
+_narrators: OrderedDict[str, Narrator] = OrderedDict()
+_narrators_lock = threading.Lock()  # The LRU reordering isn't atomic across threads
+
+def get_narrator(book_id: str, narrator_cls: type[Narrator]) -> Narrator:
+    with _narrators_lock:
+        narrator = _narrators.get(book_id)
+        if narrator is not None:
+            _narrators.move_to_end(book_id)
+            return narrator
+        narrator = narrator_cls(book_id)
+        _narrators[book_id] = narrator
+        while len(_narrators) > MAX_BOOKS_IN_MEMORY:
+            _narrators.popitem(last=False)
+        return narrator
@@ -0,0 +1,70 @@
+import hashlib
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from contextlib import suppress
+from pathlib import Path
+from typing import Optional
+
+# Content-addressed on-disk cache for synthesized audio, so re-synthesizing identical text
+# (retries, re-reads, a second user on the same book) is a disk read instead of a paid TTS call.
+class TTSDiskCache:
+    def __init__(self, cache_dir: Path, max_bytes: int):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._index: Optional[OrderedDict[Path, int]] = None  # LRU of cached file -> size, loaded lazily
+        self._total_bytes = 0
+        self._lock = threading.Lock()  # get/put run in worker threads
+
+    @staticmethod
+    def make_key(text: str, voice: str, model: str, response_format: str) -> str:
+        return hashlib.sha256(f"{model}|{response_format}|{voice}|{text}".encode()).hexdigest()
+
+    def _path_for(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / key
+
+    def _load_index(self) -> OrderedDict[Path, int]:
+        if self._index is None:
+            entries = []
+            if self.cache_dir.exists():
+                for path in self.cache_dir.glob("*/*"):
+                    if path.is_file() and not path.name.endswith(".tmp"):
+                        stat = path.stat()
+                        entries.append((stat.st_mtime, path, stat.st_size))
+            entries.sort()
+            self._index = OrderedDict((path, size) for _, path, size in entries)
+            self._total_bytes = sum(self._index.values())
+        return self._index
+
+    def get(self, key: str) -> Optional[bytes]:
+        path = self._path_for(key)
+        try:
+            content = path.read_bytes()
+        except FileNotFoundError:
+            return None
+        with self._lock:
+            index = self._load_index()
+            if path in index:
+                index.move_to_end(path)
+                # Under the lock, eviction can't unlink it in between. Still suppressed for a file
+                # removed outside the cache, the content has been read either way
+                with suppress(FileNotFoundError):
+                    os.utime(path)  # Keeps recency across restarts, the index is rebuilt from mtimes
+        return content
+
+    def put(self, key: str, content: bytes | bytearray) -> None:
+        path = self._path_for(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f"{path.name}.{uuid.uuid4().hex}.tmp")
+        tmp_path.write_bytes(content)
+        os.replace(tmp_path, path)  # Atomic, readers never see a partial file
+
+        with self._lock:
+            index = self._load_index()
+            self._total_bytes += len(content) - index.pop(path, 0)
+            index[path] = len(content)
+            while self._total_bytes > self.max_bytes and len(index) > 1:
+                old_path, old_size = index.popitem(last=False)
+                self._total_bytes -= old_size
+                old_path.unlink(missing_ok=True)
@@ -1,144 +1,359 @@
+import asyncio
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import logging
+import os
 from pathlib import Path
 import uuid
-from PyPDF2 import PdfReader
-from typing import Dict, List, Optional
+from typing import BinaryIO, Dict, List, Optional, Tuple
 import numpy as np
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from app.db.vector_database import get_vector_db, get_embedder
-from app.db.database import create_book, create_user_book_state, create_page
-from app.models.models import Book, UserBookState, Page
-
-def _hash_consolidation_check(file_path: Path) -> bool:
-    # TODO: Implement hash consolidation check
-    return False
-
-def _create_table_of_contents(reader: PdfReader) -> Dict:
-    toc = {}
-    if not reader.outline:
-        return toc
-        
-    def process_outline_item(item) -> Dict:
-        if isinstance(item, dict):
-            return {
-                'title': item.get('/Title', ''),
-                'page_number': 0, # everything about TOC needs to change
-                'timestamp': 0.0
-            }
-        elif isinstance(item, list):
-            # Handle nested chapters like in Great Gatsby
-            return [process_outline_item(subitem) for subitem in item]
+from app.config import EMBEDDING_CONCURRENCY
+from app.core import minhash
+from app.core.pdf_extraction import extract_pages_text, read_outline
+from app.db.vector_database import TextEmbedder, get_vector_db, get_embedder, quantize_int8
+from app.db.database import (
+    cache_embeddings, claim_failed_book, create_book_if_new, create_user_book_state, create_pages_bulk, get_async_db,
+    get_book_by_content_hash, get_books_sharing_bands, get_cached_embeddings, get_user_book_state_id,
+    merge_book_into, save_book_minhash, set_book_ingest_status
+)
+from app.models.models import INGEST_FAILED, INGEST_PENDING, INGEST_READY, Book, UserBookState, Page
+
+logger = logging.getLogger(__name__)
+
+EMBED_BATCH_SIZE = 16  # Pages embedded per hand-off to the persist stage
+PIPELINE_QUEUE_SIZE = 32  # Embedded pages allowed to wait on the database before embedding pauses
+PERSIST_BATCH_SIZE = 256  # Pages written per bulk insert
+NEAR_DUPLICATE_THRESHOLD = 0.9  # Estimated Jaccard similarity of two books' text shingles
+EMBED_CACHE_MIN_CHARS = 200  # Shorter pages are embedded directly, the cache round-trip isn't worth it
+UPLOAD_COPY_CHUNK_SIZE = 1 << 20  # Bytes copied per read when saving an upload
+
+INITIAL_CURSOR = {
+    'page': 0,
+    'paragraph': 0,
+    'sentence': 0,
+    'timestamp': 0.0
+}
+DEFAULT_VOICE_SETTINGS = {
+    'speed': 1.0,
+    'voice': 'default',
+    'volume': 1.0
+}
+
+EXTRACTION_WORKERS = os.cpu_count() or 1
+MIN_PAGES_PER_SHARD = 8  # Below this a worker spends more time parsing the PDF's structure than extracting
+
+_extraction_pool = None
+
+def _new_content_hash(data: bytes = b""):
+    return hashlib.blake2b(data, digest_size=32)
+
+def _hash_file(file_path: Path) -> bytes:
+    # file_digest reads into one reused buffer and hashes it in C, without holding the file in memory
+    with open(file_path, 'rb') as f:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)  # Read ahead harder
+        return hashlib.file_digest(f, _new_content_hash).digest()
+
+async def _hash_consolidation_check(content_hash: bytes) -> Optional[Book]:
+    """Returns the already processed book with the same file contents, if any"""
+    return await get_book_by_content_hash(content_hash)
+
+class NearDuplicateBook(Exception):
+    """Raised inside the upload pipeline to abandon an upload whose text nearly matches a stored book"""
+    def __init__(self, book: Book):
+        super().__init__(book.id)
+        self.book = book
+
+async def _near_duplicate_check(signature: np.ndarray) -> Optional[Book]:
+    """Returns the most similar stored book if its text is a near-copy, e.g. a re-export of the same PDF"""
+    if minhash.is_empty(signature):
         return None
-        
-    # Process each outline item
-    for i, item in enumerate(reader.outline):
-        result = process_outline_item(item)
-        if isinstance(result, list):
-            # TODO: Fix, this should probably be a list rather than a dict
-            for j, chapter in enumerate(result):
-                if chapter:  # Only add valid entries
-                    toc[str(j)] = chapter
-        elif result:
-            toc[str(i)] = result
-            
-    return toc
-
-def _extract_pages_text(reader: PdfReader) -> List[str]:
-    pages = []
-    index = 0
-    for page in reader.pages:
-        print(f"Extracting text from page {(index := index + 1)}")
-        pages.append(page.extract_text())
-    return pages
-
-def _embed_pages(pages: List[str]) -> List[np.ndarray]:
-    print("Embedding pages")
-    embedder = get_embedder()
-    print("Embedding pages done")
-    return [embedder.embed_text(page) for page in pages]    
+    best, best_similarity = None, NEAR_DUPLICATE_THRESHOLD
+    for candidate in await get_books_sharing_bands(minhash.band_keys(signature)):
+        similarity = minhash.jaccard(signature, np.frombuffer(candidate.minhash, dtype=np.uint64))
+        if similarity >= best_similarity:
+            best, best_similarity = candidate, similarity
+    return best
+
+def _get_extraction_pool() -> ProcessPoolExecutor:
+    global _extraction_pool
+    if _extraction_pool is None:
+        _extraction_pool = ProcessPoolExecutor(max_workers=EXTRACTION_WORKERS)
+    return _extraction_pool
+
+async def _read_outline(file_path: Path) -> Tuple[Dict, int]:
+    # PyPDF2 is pure Python, in a thread it would still hold the GIL the server needs
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_extraction_pool(), read_outline, str(file_path))
 
-def _chunk_page(page_text: str) -> Dict[str, List[str]]:
+async def _extract_stage(file_path: Path, total_pages: int, queue: asyncio.Queue) -> np.ndarray:
+    loop = asyncio.get_running_loop()
+    pool = _get_extraction_pool()
+    # Equal page ranges, about one per worker, so each worker opens the PDF once rather than per page
+    shard_size = max(MIN_PAGES_PER_SHARD, -(-total_pages // EXTRACTION_WORKERS))
+    shards = [
+        loop.run_in_executor(pool, extract_pages_text, str(file_path), start, min(start + shard_size, total_pages))
+        for start in range(0, total_pages, shard_size)
+    ]
+    try:
+        # Shards run concurrently, every one is waited for: the near-duplicate check needs the whole text
+        results = [await shard for shard in shards]
+    finally:
+        for shard in shards:
+            shard.cancel()  # Shards not yet picked up by a worker are dropped if the upload fails
+
+    signature = minhash.empty_signature()
+    for _, shard_signature in results:
+        np.minimum(signature, shard_signature, out=signature)
+    # Checked before any page is handed on, so a near-copy of a stored book costs no embedding requests
+    duplicate = await _near_duplicate_check(signature)
+    if duplicate is not None:
+        raise NearDuplicateBook(duplicate)
+
+    for pages, _ in results:
+        for page_text in pages:
+            await queue.put(page_text)
+    await queue.put(None)
+    return signature
+
+async def _embed_pages(pages: List[str]) -> np.ndarray:
+    logger.debug("Embedding %d pages", len(pages))
+    embeddings = await get_embedder().aembed_texts(pages)
+    logger.debug("Embedding %d pages done", len(pages))
+    return embeddings
+
+async def _embed_pages_cached(pages: List[str]) -> np.ndarray:
+    """Embeds pages, reusing cached embeddings of identical page text and caching the new ones"""
+    model = get_embedder().model
+    keys = [
+        _new_content_hash(page.encode()).digest() if len(page) >= EMBED_CACHE_MIN_CHARS else None
+        for page in pages
+    ]
+    cached = await get_cached_embeddings([key for key in keys if key is not None], model)
+    missing = [i for i, key in enumerate(keys) if key not in cached]
+    if not missing:
+        return np.stack([cached[key] for key in keys])
+
+    fresh = await _embed_pages([pages[i] for i in missing])
+    await cache_embeddings({keys[i]: fresh[j] for j, i in enumerate(missing) if keys[i] is not None}, model)
+    if len(missing) == len(pages):
+        return fresh
+    embeddings = np.empty((len(pages), fresh.shape[1]), dtype=np.float32)
+    embeddings[missing] = fresh
+    for i, key in enumerate(keys):
+        if key in cached:
+            embeddings[i] = cached[key]
+    return embeddings
+
+async def _embed_stage(pages: asyncio.Queue, queue: asyncio.Queue) -> None:
+    page_num = 0
+    # Several batches are embedded at once, up to the embedding concurrency, and handed on in page order
+    in_flight = deque()
+    done = False
+    try:
+        while not done:
+            batch = []
+            while len(batch) < EMBED_BATCH_SIZE:
+                page_text = await pages.get()
+                if page_text is None:
+                    done = True
+                    break
+                batch.append(page_text)
+            if batch:
+                in_flight.append((page_num, batch, asyncio.create_task(_embed_pages_cached(batch))))
+                page_num += len(batch)
+            while in_flight and (done or len(in_flight) >= EMBEDDING_CONCURRENCY):
+                first_page, batch, task = in_flight.popleft()
+                embeddings = await task
+                quantized, scales = quantize_int8(embeddings)  # Whole batch at once
+                for offset, (page_text, embedding, embedding_int8, scale) in enumerate(zip(batch, embeddings, quantized, scales)):
+                    await queue.put((first_page + offset, page_text, embedding, embedding_int8.tobytes(), float(scale)))
+    finally:
+        for _, _, task in in_flight:
+            task.cancel()  # Only left over when the upload failed
+    await queue.put(None)
+
+async def _persist_stage(book_id: str, queue: asyncio.Queue, db: AsyncSession) -> None:
+    rows = []
     embedder = get_embedder()
-    paragraphs = embedder.chunk_text(page_text, method="paragraphs")
-    sentences = embedder.chunk_text(page_text, method="sentences")
-    return {
-        'paragraphs': paragraphs,
-        'sentences': sentences
-    }
+    while (item := await queue.get()) is not None:
+        page_num, page_text, embedding, embedding_int8, embedding_scale = item
+        logger.debug("Saving page %d", page_num)
+        chunks = _chunk_page(page_text, embedder)
+        rows.append({
+            'book_id': book_id,
+            'page_number': page_num,
+            'paragraphed_text': chunks['paragraphs'],
+            'sentenced_text': chunks['sentences'],
+            'embedding': embedding,
+            'embedding_int8': embedding_int8,
+            'embedding_scale': embedding_scale,
+            'chunk_embeddings': None  # Optional, can be updated later if needed
+        })
+        if len(rows) >= PERSIST_BATCH_SIZE:
+            await create_pages_bulk(rows, db=db)
+            rows = []
+    await create_pages_bulk(rows, db=db)
 
-async def process_pdf_upload(file_path: Path, user_id: str) -> Dict:
+def _chunk_page(page_text: str, embedder: TextEmbedder) -> Dict[str, List[str]]:
+    return embedder.chunk_text_multi(page_text, methods=("paragraphs", "sentences"))
+
+async def process_pdf_upload(file_path: Path, user_id: str, file_blob: Optional[bytes] = None, content_hash: Optional[bytes] = None) -> Dict:
     """
     Process an uploaded PDF file and create all necessary database entries.
+    Pass file_blob if the file's bytes are already in memory to skip reading it from disk,
+    and content_hash if save_uploaded_file already computed it.
     Returns a dictionary containing book metadata.
     """
-    reader = PdfReader(str(file_path))
-    
-    # Read file content for storage
-    with open(file_path, 'rb') as f:
-        file_blob = f.read()
-    
-    # Extract basic metadata
-    toc = _create_table_of_contents(reader)
-    total_pages = len(reader.pages)
-    print(f"Total pages: {total_pages}")
-    
-    # Create book entry
-    book = await create_book(
-        reference_string=file_path.name,
-        file_blob=file_blob,
-        total_pages=total_pages,
-        table_of_contents=toc
-    )
-    
-    # Initialize user book state
-    initial_cursor = {
-        'page': 0,
-        'paragraph': 0,
-        'sentence': 0,
-        'timestamp': 0.0
-    }
-    default_voice_settings = {
-        'speed': 1.0,
-        'voice': 'default',
-        'volume': 1.0
-    }
-    
-    book_state = await create_user_book_state(
-        user_id=user_id,
-        book_id=book.id,
-        cursor_position=initial_cursor,
-        voice_settings=default_voice_settings
-    )
-    print(f"Book state created: {book_state.id}")
-    # Process pages
-    pages = _extract_pages_text(reader)
-    embeddings = _embed_pages(pages)
-    
-    # Create page entries with chunking and embeddings
-    for page_num, (page_text, embedding) in enumerate(zip(pages, embeddings)):
-        print("Saving page", page_num)
-        chunks = _chunk_page(page_text)
-        
-        # Create page with all data
-        await create_page(
-            book_id=book.id,
-            page_number=page_num,
-            paragraphed_text=chunks['paragraphs'],
-            sentenced_text=chunks['sentences'],
-            embedding=embedding,
-            chunk_embeddings=None  # Optional, can be updated later if needed
+    metadata, is_new = await register_pdf_upload(file_path, user_id, file_blob, content_hash)
+    if not is_new:
+        return metadata
+    merged = await ingest_pdf_pages(metadata['id'], file_path, metadata['total_pages'], user_id)
+    return merged or {**metadata, 'ingest_status': INGEST_READY}
+
+async def register_pdf_upload(file_path: Path, user_id: str, file_blob: Optional[bytes] = None, content_hash: Optional[bytes] = None) -> Tuple[Dict, bool]:
+    """
+    The part of an upload the reader waits for: deduplicates the file and creates the book and
+    the reader's state from the PDF's outline alone, no page text is extracted.
+    Returns the book metadata and whether the book is new, new books still need ingest_pdf_pages.
+    A re-upload of a file whose ingest failed counts as new, so it is ingested again.
+    """
+    # The outline is parsed in a worker process while the file is hashed and checked for
+    # duplicates, rather than after; a duplicate just drops the parse
+    outline = asyncio.create_task(_read_outline(file_path))
+    try:
+        if content_hash is None:
+            if file_blob is not None:
+                content_hash = _new_content_hash(file_blob).digest()
+            else:
+                # Hashed from disk, a duplicate never has to be read into memory
+                content_hash = await asyncio.to_thread(_hash_file, file_path)
+
+        # The same PDF was processed before, reuse it instead of parsing and embedding it again
+        existing_book = await _hash_consolidation_check(content_hash)
+        if existing_book is not None:
+            outline.cancel()
+            return await _reuse_existing_book(existing_book, file_path, user_id)
+
+        # Read file content for storage
+        if file_blob is None:
+            file_blob = await asyncio.to_thread(file_path.read_bytes)
+
+        toc, total_pages = await outline
+    finally:
+        outline.cancel()  # No-op once it finished, stops a parse nobody will await on failure
+    logger.debug("Total pages: %d", total_pages)
+
+    async with get_async_db() as db, db.begin():
+        # Create book entry
+        book_id = await create_book_if_new(
+            reference_string=file_path.name,
+            file_blob=file_blob,
+            total_pages=total_pages,
+            table_of_contents=toc,
+            content_hash=content_hash,
+            db=db
         )
-    
+        if book_id is not None:
+            book_state = await create_user_book_state(
+                user_id=user_id,
+                book_id=book_id,
+                cursor_position=INITIAL_CURSOR,
+                voice_settings=DEFAULT_VOICE_SETTINGS,
+                db=db
+            )
+            logger.debug("Book state created: %s", book_state.id)
+
+    # A concurrent upload of the same file committed its book between our check and insert
+    if book_id is None:
+        return await _reuse_existing_book(await _hash_consolidation_check(content_hash), file_path, user_id)
+
     return {
-        'id': book.id,
+        'id': book_id,
         'reference_string': file_path.name,
         'total_pages': total_pages,
         'table_of_contents': toc,
+        'ingest_status': INGEST_PENDING,
         'user_book_state_id': book_state.id
+    }, True
+
+async def _reuse_existing_book(book: Book, file_path: Path, user_id: str) -> Tuple[Dict, bool]:
+    # A failed ingest is retried from this upload's file by whichever re-upload claims it first
+    if book.ingest_status == INGEST_FAILED and await claim_failed_book(book.id):
+        book.ingest_status = INGEST_PENDING
+        return await _existing_book_metadata(book, user_id), True
+    file_path.unlink(missing_ok=True)  # The stored copy is the existing book's file_blob
+    return await _existing_book_metadata(book, user_id), False
+
+async def ingest_pdf_pages(book_id: str, file_path: Path, total_pages: int, user_id: str) -> Optional[Dict]:
+    """
+    Extracts, embeds and saves the pages of a book made by register_pdf_upload, meant to run after
+    the upload has been answered, and marks it ready. If the text turns out to nearly match a stored
+    book, this one is merged into it and the stored book's metadata is returned, otherwise None.
+    A failed ingest marks the book failed, readers keep their states and a re-upload retries it.
+    """
+    # One transaction for all pages: a single commit, and a failure anywhere leaves no partial page set
+    near_duplicate = None
+    try:
+        async with get_async_db() as db, db.begin():
+            # Process pages: once the text is extracted and checked for near-copies, embedding and saving
+            # overlap, each stage works on the pages the one before it has finished while bounded queues
+            # keep the stages in step
+            pages = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+            queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+            async with asyncio.TaskGroup() as group:
+                extraction = group.create_task(_extract_stage(file_path, total_pages, pages))
+                group.create_task(_embed_stage(pages, queue))
+                group.create_task(_persist_stage(book_id, queue, db))
+
+            signature = extraction.result()
+            if not minhash.is_empty(signature):
+                await save_book_minhash(book_id, signature.tobytes(), minhash.band_keys(signature), db=db)
+            await set_book_ingest_status(book_id, INGEST_READY, db=db)  # Committed with the pages
+    except* NearDuplicateBook as duplicates:
+        near_duplicate = duplicates.exceptions[0].book
+    except* Exception:
+        # Not deleted: readers who uploaded the same file meanwhile already hold this id
+        logger.exception("Ingesting book %s failed", book_id)
+        await set_book_ingest_status(book_id, INGEST_FAILED)
+        raise
+
+    if near_duplicate is None:
+        logger.debug("Ingested book: %s", book_id)
+        return None
+
+    # Pages rolled back, readers of this copy are moved over to the book it nearly matched
+    await merge_book_into(book_id, near_duplicate.id)
+    file_path.unlink(missing_ok=True)
+    return await _existing_book_metadata(near_duplicate, user_id)
+
+async def _existing_book_metadata(book: Book, user_id: str) -> Dict:
+    async with get_async_db() as db, db.begin():
+        book_state_id = await get_user_book_state_id(user_id, book.id, db=db)
+        if book_state_id is None:
+            book_state = await create_user_book_state(
+                user_id=user_id,
+                book_id=book.id,
+                cursor_position=INITIAL_CURSOR,
+                voice_settings=DEFAULT_VOICE_SETTINGS,
+                db=db
+            )
+            book_state_id = book_state.id
+    return {
+        'id': book.id,
+        'reference_string': book.reference_string,
+        'total_pages': book.total_pages,
+        'table_of_contents': book.table_of_contents,
+        'ingest_status': book.ingest_status,
+        'user_book_state_id': book_state_id
     }
 
-def save_uploaded_file(file_content: bytes, filename: str, upload_dir: Path) -> Path:
+def save_uploaded_file(file_obj: BinaryIO, filename: str, upload_dir: Path) -> Tuple[Path, int, bytes]:
     """
-    Save an uploaded file to disk and return its path.
+    Stream an uploaded file to disk and return its path, size in bytes and content hash.
     """
     # Create upload directory if it doesn't exist
     upload_dir.mkdir(parents=True, exist_ok=True)
@@ -146,7 +361,15 @@ def save_uploaded_file(file_content: bytes, filename: str, upload_dir: Path) ->
     # Generate unique filename to avoid collisions
     file_path = upload_dir / f"{uuid.uuid4()}_{filename}"
     
+    # Hashed while it is copied, so deduplication costs no extra read
+    content_hash = _new_content_hash()
+    # One buffer reused for every read instead of a new bytes object per chunk
+    buffer = bytearray(UPLOAD_COPY_CHUNK_SIZE)
+    view = memoryview(buffer)
     with open(file_path, 'wb') as f:
-        f.write(file_content)
-    print(f"File saved to: {file_path}")
-    return file_path
+        while n := file_obj.readinto(buffer):
+            content_hash.update(view[:n])
+            f.write(view[:n])
+        size = f.tell()
+    logger.debug("File saved to: %s", file_path)
+    return file_path, size, content_hash.digest()
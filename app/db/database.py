@@ -1,22 +1,38 @@
-from sqlalchemy import create_engine, select, and_
-from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy import Row, bindparam, create_engine, delete, event, exists, insert, select, update, and_, tuple_
+from sqlalchemy.orm import load_only, sessionmaker, undefer, Session
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from contextlib import contextmanager, asynccontextmanager
-from app.config import DATABASE_URL
-from typing import Optional, List, Dict
+from app.config import DATABASE_URL, SQL_ECHO
+from typing import AsyncIterator, Optional, List, Dict, Tuple
 from uuid import UUID
-from app.models.models import AudioChunk, Page, User, Book, UserBookState, VerificationCode
+from app.models.models import INGEST_FAILED, INGEST_MERGED, INGEST_PENDING, AudioChunk, Bookmark, BookFile, BookMinHashBand, EmbeddingCache, Page, Question, User, Book, UserBookState, VerificationCode
 from datetime import datetime
+import secrets
+import uuid
 import numpy as np
+from pgvector.asyncpg import register_vector
 
 # Sync SQLAlchemy engine
-engine = create_engine(DATABASE_URL, echo=True)
+engine = create_engine(DATABASE_URL, echo=SQL_ECHO, echo_pool=False)
 SessionLocal = sessionmaker(bind=engine)
 
+def async_database_url(url: str) -> str:
+    """The asyncpg form of a postgresql:// URL"""
+    return url.replace('postgresql://', 'postgresql+asyncpg://').replace("?sslmode=", "?ssl=")
+
 # Async engine
 async_engine = create_async_engine(
-    DATABASE_URL.replace('postgresql://', 'postgresql+asyncpg://').replace("?sslmode=", "?ssl=")
+    async_database_url(DATABASE_URL),
+    echo=SQL_ECHO,
+    echo_pool=False
 )
+
+@event.listens_for(async_engine.sync_engine, "connect")
+def _register_vector_codec(dbapi_connection, connection_record):
+    # Vectors travel in pgvector's binary format, numpy arrays in and out with no text round-trip
+    dbapi_connection.run_async(register_vector)
+
 AsyncSessionLocal = sessionmaker(
     async_engine, 
     class_=AsyncSession, 
@@ -39,22 +55,32 @@ async def get_async_db() -> AsyncSession:
         finally:
             await session.close()
 
-async def get_user_by_email(email: str) -> Optional[User]:
-    async with AsyncSessionLocal() as session:
+@asynccontextmanager
+async def _use_session(db: Optional[AsyncSession] = None) -> AsyncSession:
+    """Yields the caller's session when given one, so a chain of calls shares one connection
+    and transaction instead of checking out a connection each, otherwise opens a new one"""
+    if db is not None:
+        yield db
+        return
+    async with get_async_db() as session:
+        yield session
+
+async def get_user_by_email(email: str, db: Optional[AsyncSession] = None) -> Optional[User]:
+    async with _use_session(db) as session:
         result = await session.execute(
             select(User).where(User.email == email)
         )
         return result.scalar_one_or_none()
 
-async def get_book_by_id(book_id: UUID) -> Optional[dict]:
-    async with get_async_db() as session:
+async def get_book_by_id(book_id: UUID, db: Optional[AsyncSession] = None) -> Optional[dict]:
+    async with _use_session(db) as session:
         result = await session.execute(
             select(Book).where(Book.id == book_id)
         )
         return result.scalar_one_or_none()
 
-async def get_user_book_state(user_id: UUID, book_id: UUID) -> Optional[dict]:
-    async with get_async_db() as session:
+async def get_user_book_state(user_id: UUID, book_id: UUID, db: Optional[AsyncSession] = None) -> Optional[dict]:
+    async with _use_session(db) as session:
         result = await session.execute(
             select(UserBookState).where(
                 and_(
@@ -65,6 +91,21 @@ async def get_user_book_state(user_id: UUID, book_id: UUID) -> Optional[dict]:
         )
         return result.scalar_one_or_none()
 
+async def get_user_book_state_id(user_id: str, book_id: str, db: Optional[AsyncSession] = None) -> Optional[str]:
+    """
+    Gets only the id of the user's state for a book, for when all that matters is whether it exists
+    """
+    async with _use_session(db) as session:
+        result = await session.execute(
+            select(UserBookState.id).where(
+                and_(
+                    UserBookState.user_id == user_id,
+                    UserBookState.book_id == book_id
+                )
+            )
+        )
+        return result.scalar_one_or_none()
+
 async def create_verification_code(email: str, code: str, expires_at: datetime) -> VerificationCode:
     async with AsyncSessionLocal() as session:
         verification_code = VerificationCode(
@@ -77,53 +118,233 @@ async def create_verification_code(email: str, code: str, expires_at: datetime)
         await session.refresh(verification_code)
         return verification_code
 
+MAX_VERIFICATION_ATTEMPTS = 5  # Guesses an email gets per code before it has to request a new one
+
 async def get_valid_verification_code(email: str, code: str) -> Optional[VerificationCode]:
+    """
+    Gets the email's outstanding code equal to code. Every call counts as an attempt against all of
+    the email's outstanding codes, in the same statement that fetches them so concurrent guesses can't
+    slip past the limit, and the comparison is constant-time so timing gives nothing away
+    """
     async with AsyncSessionLocal() as session:
         result = await session.execute(
-            select(VerificationCode).where(
-                and_(
-                    VerificationCode.email == email,
-                    VerificationCode.code == code,
-                    VerificationCode.used == False,
-                    VerificationCode.expires_at > datetime.utcnow()
-                )
-            ).order_by(VerificationCode.created_at.desc())
+            update(VerificationCode)
+            .where(
+                VerificationCode.email == email,
+                VerificationCode.used == False,
+                VerificationCode.expires_at > datetime.utcnow(),
+                VerificationCode.attempts < MAX_VERIFICATION_ATTEMPTS
+            )
+            .values(attempts=VerificationCode.attempts + 1)
+            .returning(VerificationCode)
+            .execution_options(synchronize_session=False)
         )
-        return result.scalar_one_or_none()
+        candidates = result.scalars().all()
+        await session.commit()
+    match = None
+    for candidate in candidates:  # No early exit, every candidate is compared
+        if secrets.compare_digest(candidate.code.encode(), code.encode()):
+            match = candidate
+    return match
 
-async def create_book(reference_string: str, file_blob: bytes, total_pages: int, table_of_contents: dict) -> Book:
+async def _save(obj, db: Optional[AsyncSession] = None):
+    """
+    Adds obj to the caller's session, flushed but committed along with the rest of its transaction,
+    or without one, saves it in its own session and commits
+    """
+    if db is not None:
+        db.add(obj)
+        await db.flush()
+        return obj
     async with AsyncSessionLocal() as session:
-        book = Book(
-            reference_string=reference_string,
-            file_blob=file_blob,
-            total_pages=total_pages,
-            table_of_contents=table_of_contents
-        )
-        session.add(book)
+        session.add(obj)
         await session.commit()
-        await session.refresh(book)
+        await session.refresh(obj)
+        return obj
+
+_UPLOAD_REPLY_COLUMNS = (
+    Book.id, Book.reference_string, Book.total_pages, Book.table_of_contents, Book.ingest_status, Book.merged_into
+)
+
+async def get_book_by_content_hash(content_hash: bytes, db: Optional[AsyncSession] = None) -> Optional[Book]:
+    """
+    Gets the book with these file contents, or the one it was merged into,
+    loading only what an upload reply needs, not its minhash
+    """
+    async with _use_session(db) as session:
+        result = await session.execute(
+            select(Book)
+            .options(load_only(*_UPLOAD_REPLY_COLUMNS))
+            .where(Book.content_hash == content_hash)
+        )
+        book = result.scalar_one_or_none()
+        if book is not None and book.merged_into is not None:
+            book = await session.get(Book, book.merged_into, options=[load_only(*_UPLOAD_REPLY_COLUMNS)])
         return book
 
-async def get_pages_from_book(book_id: str, start_page: int, num_pages: int) -> List[Page]:
+async def get_merged_book_id(book_id: str, db: Optional[AsyncSession] = None) -> Optional[str]:
+    """Gets the id of the book this one was merged into, None unless it was merged"""
+    async with _use_session(db) as session:
+        result = await session.execute(select(Book.merged_into).where(Book.id == book_id))
+        return result.scalar_one_or_none()
+
+async def set_book_ingest_status(book_id: str, status: str, db: Optional[AsyncSession] = None) -> None:
+    async with _use_session(db) as session:
+        await session.execute(update(Book).where(Book.id == book_id).values(ingest_status=status))
+        if db is None:
+            await session.commit()
+
+async def claim_failed_book(book_id: str, db: Optional[AsyncSession] = None) -> bool:
+    """
+    Sets a book whose ingest failed back to pending, True if this call did so.
+    Of concurrent re-uploads of the same file only one gets to retry the ingest
+    """
+    async with _use_session(db) as session:
+        result = await session.execute(
+            update(Book)
+            .where(Book.id == book_id, Book.ingest_status == INGEST_FAILED)
+            .values(ingest_status=INGEST_PENDING)
+            .returning(Book.id)
+        )
+        claimed = result.scalar_one_or_none() is not None
+        if db is None:
+            await session.commit()
+        return claimed
+
+async def get_books_sharing_bands(band_keys: List[bytes], db: Optional[AsyncSession] = None) -> List[Book]:
+    """
+    Gets the books whose MinHash signature shares at least one LSH band key, the near-duplicate candidates
+    """
+    async with _use_session(db) as session:
+        result = await session.execute(
+            select(Book)
+            .where(Book.id.in_(
+                select(BookMinHashBand.book_id).where(
+                    tuple_(BookMinHashBand.band, BookMinHashBand.band_hash).in_(list(enumerate(band_keys)))
+                )
+            ))
+        )
+        return result.scalars().all()
+
+async def save_book_minhash(book_id: str, signature: bytes, band_keys: List[bytes], db: Optional[AsyncSession] = None) -> None:
+    rows = [{'band': band, 'band_hash': band_hash, 'book_id': book_id} for band, band_hash in enumerate(band_keys)]
+    if db is not None:
+        await _save_book_minhash(db, book_id, signature, rows)
+        return
     async with AsyncSessionLocal() as session:
+        await _save_book_minhash(session, book_id, signature, rows)
+        await session.commit()
+
+async def _save_book_minhash(session: AsyncSession, book_id: str, signature: bytes, rows: List[Dict]) -> None:
+    await session.execute(update(Book).where(Book.id == book_id).values(minhash=signature))
+    await session.execute(insert(BookMinHashBand), rows)
+
+async def merge_book_into(book_id: str, target_id: str, db: Optional[AsyncSession] = None) -> None:
+    """
+    Moves readers' states, bookmarks and questions from one book to another, then empties the first.
+    A reader who already has a state for the target keeps that one. The first book's row stays,
+    marked merged, so its id and content hash still lead to the target
+    """
+    async with _use_session(db) as session:
+        other = UserBookState.__table__.alias()
+        await session.execute(
+            delete(UserBookState).where(
+                UserBookState.book_id == book_id,
+                exists().where(other.c.book_id == target_id, other.c.user_id == UserBookState.user_id)
+            )
+        )
+        for model in (UserBookState, Bookmark, Question):
+            await session.execute(update(model).where(model.book_id == book_id).values(book_id=target_id))
+        for model in (Page, AudioChunk, BookMinHashBand, BookFile):
+            await session.execute(delete(model).where(model.book_id == book_id))
+        # Books merged into this one earlier point straight at the target, redirects stay one hop
+        await session.execute(update(Book).where(Book.merged_into == book_id).values(merged_into=target_id))
+        await session.execute(
+            update(Book).where(Book.id == book_id).values(ingest_status=INGEST_MERGED, merged_into=target_id)
+        )
+        if db is None:
+            await session.commit()
+
+async def delete_book(book_id: str, db: Optional[AsyncSession] = None) -> None:
+    """Deletes a book along with everything that refers to it"""
+    async with _use_session(db) as session:
+        await _delete_book(session, book_id)
+        if db is None:
+            await session.commit()
+
+async def _delete_book(session: AsyncSession, book_id: str) -> None:
+    for model in (UserBookState, Bookmark, Question, Page, AudioChunk, BookMinHashBand, BookFile):
+        await session.execute(delete(model).where(model.book_id == book_id))
+    await session.execute(delete(Book).where(Book.id == book_id))
+
+async def create_book(reference_string: str, file_blob: bytes, total_pages: int, table_of_contents: dict, content_hash: Optional[bytes] = None, db: Optional[AsyncSession] = None) -> Book:
+    book = Book(
+        id=str(uuid.uuid4()),
+        reference_string=reference_string,
+        content_hash=content_hash,
+        total_pages=total_pages,
+        table_of_contents=table_of_contents
+    )
+    async with _use_session(db) as session:
+        session.add_all([book, BookFile(book_id=book.id, file_blob=file_blob)])
+        if db is None:
+            await session.commit()
+        else:
+            await session.flush()
+    return book
+
+async def create_book_if_new(reference_string: str, file_blob: bytes, total_pages: int, table_of_contents: dict, content_hash: bytes, db: Optional[AsyncSession] = None) -> Optional[str]:
+    """
+    Creates a book unless one with these file contents exists, returning its id or None.
+    Concurrent uploads of the same file wait on each other's insert instead of failing on the unique content_hash
+    """
+    async with _use_session(db) as session:
+        result = await session.execute(
+            pg_insert(Book)
+            .values(
+                id=str(uuid.uuid4()),
+                reference_string=reference_string,
+                content_hash=content_hash,
+                total_pages=total_pages,
+                table_of_contents=table_of_contents,
+                ingest_status=INGEST_PENDING  # Until ingest_pdf_pages has saved its pages
+            )
+            .on_conflict_do_nothing(index_elements=[Book.content_hash])
+            .returning(Book.id)
+        )
+        book_id = result.scalar_one_or_none()
+        if book_id is not None:
+            await session.execute(insert(BookFile).values(book_id=book_id, file_blob=file_blob))
+        if db is None:
+            await session.commit()
+        return book_id
+
+async def get_pages_from_book(book_id: str, start_page: int, num_pages: int, columns: Optional[Tuple[str, ...]] = None, db: Optional[AsyncSession] = None) -> List[Page]:
+    """
+    Gets up to num_pages pages of a book starting at start_page.
+    Pass columns, e.g. ('page_number', 'audio_blob'), to load only those instead of full Page rows,
+    the results are then rows with those attributes
+    """
+    async with _use_session(db) as session:
         # Get book to check total pages
         book_result = await session.execute(
-            select(Book).where(Book.id == book_id)
+            select(Book.total_pages).where(Book.id == book_id)
         )
-        book = book_result.scalar_one_or_none()
+        total_pages = book_result.scalar_one_or_none()
         
-        if not book:
+        if total_pages is None:
             return []
             
         # Adjust num_pages if it would exceed book length
-        pages_remaining = book.total_pages - start_page + 1
+        pages_remaining = total_pages - start_page + 1
         pages_to_fetch = min(num_pages, pages_remaining)
         
         if pages_to_fetch <= 0:
             return []
             
+        query = select(*(getattr(Page, c) for c in columns)) if columns else select(Page)
         result = await session.execute(
-            select(Page)
+            query
             .where(
                 and_(
                     Page.book_id == book_id,
@@ -134,60 +355,119 @@ async def get_pages_from_book(book_id: str, start_page: int, num_pages: int) ->
             .order_by(Page.page_number)
         )
         
-        return result.scalars().all()
+        return result.all() if columns else result.scalars().all()
 
-async def create_user_book_state(user_id: str, book_id: str, cursor_position: Dict, voice_settings: Dict) -> UserBookState:
-    async with AsyncSessionLocal() as session:
-        book_state = UserBookState(
-            user_id=user_id,
-            book_id=book_id,
-            cursor_position=cursor_position,
-            voice_settings=voice_settings
+async def create_user_book_state(user_id: str, book_id: str, cursor_position: Dict, voice_settings: Dict, db: Optional[AsyncSession] = None) -> UserBookState:
+    book_state = UserBookState(
+        user_id=user_id,
+        book_id=book_id,
+        cursor_position=cursor_position,
+        voice_settings=voice_settings
+    )
+    return await _save(book_state, db)
+
+# Below this many rows COPY's setup (raw connection checkout, vector codec registration)
+# costs more than it saves over a multi-row INSERT
+BULK_COPY_THRESHOLD = 100
+PAGE_COPY_COLUMNS = [
+    'id', 'book_id', 'page_number', 'chapter', 'paragraphed_text', 'sentenced_text',
+    'embedding', 'embedding_int8', 'embedding_scale', 'chunk_embeddings', 'audio_chunks'
+]
+
+async def create_pages_bulk(rows: List[Dict], db: Optional[AsyncSession] = None) -> None:
+    """
+    Inserts many pages in one round-trip. Each row is a dict of Page column values, the id is generated.
+    Large batches go through Postgres COPY, smaller ones through a single executemany INSERT.
+    Given a session, both run inside its transaction and are committed with it
+    """
+    if not rows:
+        return
+    if len(rows) < BULK_COPY_THRESHOLD:
+        if db is not None:
+            await db.execute(insert(Page), rows)
+            return
+        async with AsyncSessionLocal() as session:
+            await session.execute(insert(Page), rows)
+            await session.commit()
+        return
+
+    records = [
+        (
+            str(uuid.uuid4()),
+            row['book_id'],
+            row['page_number'],
+            row.get('chapter'),
+            row['paragraphed_text'],
+            row['sentenced_text'],
+            row['embedding'],
+            row.get('embedding_int8'),
+            row.get('embedding_scale'),
+            row.get('chunk_embeddings'),
+            row.get('audio_chunks')
+        ) for row in rows
+    ]
+    if db is not None:
+        await _copy_pages(await db.connection(), records)
+        return
+    async with async_engine.begin() as conn:
+        await _copy_pages(conn, records)
+
+async def _copy_pages(conn, records: List[tuple]) -> None:
+    raw_connection = await conn.get_raw_connection()
+    asyncpg_connection = raw_connection.driver_connection  # The vector codec is registered on connect
+    await asyncpg_connection.copy_records_to_table('pages', records=records, columns=PAGE_COPY_COLUMNS)
+
+async def get_cached_embeddings(content_hashes: List[bytes], model: str, db: Optional[AsyncSession] = None) -> Dict[bytes, np.ndarray]:
+    """
+    Gets the cached embeddings for whichever of the hashes have one, in a single query
+    """
+    if not content_hashes:
+        return {}
+    async with _use_session(db) as session:
+        result = await session.execute(
+            select(EmbeddingCache.content_hash, EmbeddingCache.embedding).where(
+                and_(
+                    EmbeddingCache.model == model,
+                    EmbeddingCache.content_hash.in_(content_hashes)
+                )
+            )
+        )
+        return {content_hash: embedding for content_hash, embedding in result}
+
+async def cache_embeddings(embeddings: Dict[bytes, np.ndarray], model: str) -> None:
+    """
+    Stores embeddings by content hash in one INSERT, entries another upload already cached are kept
+    """
+    if not embeddings:
+        return
+    async with get_async_db() as session:
+        await session.execute(
+            pg_insert(EmbeddingCache)
+            .values([
+                {'content_hash': content_hash, 'model': model, 'embedding': embedding}
+                for content_hash, embedding in embeddings.items()
+            ])
+            .on_conflict_do_nothing()
         )
-        session.add(book_state)
-        await session.commit()
-        await session.refresh(book_state)
-        return book_state
-
-async def create_page(
-    book_id: str,
-    page_number: int,
-    paragraphed_text: str,
-    sentenced_text: str,
-    embedding: np.ndarray,
-    chunk_embeddings: Optional[Dict] = None,
-    chapter: Optional[str] = None,
-    audio_chunks: Optional[Dict] = None
-) -> Page:
-    async with AsyncSessionLocal() as session:
-        page = Page(
-            book_id=book_id,
-            page_number=page_number,
-            chapter=chapter,
-            paragraphed_text=paragraphed_text,
-            sentenced_text=sentenced_text,
-            embedding=embedding.tolist(),  # Convert numpy array to list for storage
-            chunk_embeddings=chunk_embeddings,
-            audio_chunks=audio_chunks
-        )
-        session.add(page)
         await session.commit()
-        await session.refresh(page)
-        return page
 
-async def get_user_books(user_id: str) -> List[Book]:
-    async with AsyncSessionLocal() as session:
+async def get_user_books(user_id: str, db: Optional[AsyncSession] = None) -> List[Dict]:
+    """
+    Gets the metadata of a reader's books as plain dicts, selecting only those columns rather than whole rows
+    """
+    async with _use_session(db) as session:
         result = await session.execute(
-            select(Book, UserBookState)
+            select(Book.id, Book.reference_string, Book.total_pages, Book.table_of_contents, Book.ingest_status)
             .join(UserBookState, and_(
                 UserBookState.book_id == Book.id,
                 UserBookState.user_id == user_id
             ))
+            .order_by(UserBookState.last_accessed.desc())
         )
-        return [row[0] for row in result.all()]
+        return [dict(row) for row in result.mappings()]
 
-async def get_book_with_state(book_id: str, user_id: str) -> Optional[tuple[Book, UserBookState]]:
-    async with AsyncSessionLocal() as session:
+async def get_book_with_state(book_id: str, user_id: str, db: Optional[AsyncSession] = None) -> Optional[tuple[Book, UserBookState]]:
+    async with _use_session(db) as session:
         result = await session.execute(
             select(Book, UserBookState)
             .join(UserBookState, and_(
@@ -200,30 +480,83 @@ async def get_book_with_state(book_id: str, user_id: str) -> Optional[tuple[Book
         return row if row else None
 
 async def update_reading_position(user_id: str, book_id: str, position: dict) -> Optional[UserBookState]:
+    """
+    Saves the reader's position in one UPDATE ... RETURNING round-trip, None if they have no state for the book
+    """
     async with AsyncSessionLocal() as session:
         result = await session.execute(
-            select(UserBookState).where(
-                and_(
-                    UserBookState.user_id == user_id,
-                    UserBookState.book_id == book_id
-                )
+            update(UserBookState)
+            .where(
+                UserBookState.user_id == user_id,
+                UserBookState.book_id == book_id
             )
+            .values(cursor_position=position)  # last_accessed is bumped by its onupdate
+            .returning(UserBookState)
+            .execution_options(synchronize_session=False)
         )
         state = result.scalar_one_or_none()
-        if state:
-            state.cursor_position = position
-            await session.commit()
-            await session.refresh(state)
+        await session.commit()
         return state
 
-async def get_audio_chunk_for_timestamp(book_id: str, timestamp: float) -> tuple[Optional[AudioChunk], float]:
+async def update_reading_positions(positions: Dict[Tuple[str, str], dict]) -> None:
+    """
+    Saves many readers' positions, keyed by (user_id, book_id), as one executemany UPDATE.
+    Pairs without a state are skipped
+    """
+    if not positions:
+        return
+    states = UserBookState.__table__
+    async with AsyncSessionLocal() as session:
+        await session.execute(
+            update(states)
+            .where(states.c.user_id == bindparam('state_user_id'), states.c.book_id == bindparam('state_book_id'))
+            .values(cursor_position=bindparam('position')),  # last_accessed is bumped by its onupdate
+            [
+                {'state_user_id': user_id, 'state_book_id': book_id, 'position': position}
+                for (user_id, book_id), position in positions.items()
+            ]
+        )
+        await session.commit()
+
+async def get_audio_chunk_bounds(book_id: str, db: Optional[AsyncSession] = None) -> List[Tuple[float, float, int]]:
+    """
+    Gets (start_timestamp, end_timestamp, sequence_number) for every audio chunk in a book,
+    ordered by start_timestamp. Leaves out the audio itself
+    """
+    async with _use_session(db) as session:
+        result = await session.execute(
+            select(AudioChunk.start_timestamp, AudioChunk.end_timestamp, AudioChunk.sequence_number)
+            .where(AudioChunk.book_id == book_id)
+            .order_by(AudioChunk.start_timestamp)
+        )
+        return [tuple(row) for row in result]
+
+async def stream_audio_chunks(book_id: str, from_timestamp: float = 0.0, batch_size: int = 2) -> AsyncIterator[Row]:
+    """
+    Yields (sequence_number, start_timestamp, end_timestamp, audio_blob) for the book's audio chunks
+    from the one playing at from_timestamp onwards, in order. A server-side cursor fetches batch_size
+    chunks at a time, so a whole book's audio is never held at once
+    """
+    async with get_async_db() as session:
+        result = await session.stream(
+            select(AudioChunk.sequence_number, AudioChunk.start_timestamp, AudioChunk.end_timestamp, AudioChunk.audio_blob)
+            .where(AudioChunk.book_id == book_id, AudioChunk.end_timestamp > from_timestamp)
+            .order_by(AudioChunk.start_timestamp)
+            .execution_options(yield_per=batch_size)
+        )
+        async for row in result:
+            yield row
+
+async def get_audio_chunk_for_timestamp(book_id: str, timestamp: float, db: Optional[AsyncSession] = None) -> tuple[Optional[AudioChunk], float]:
     """
     Gets the audio chunk and relative position for a given timestamp in a book
     Returns (chunk, relative_position) tuple
     """
-    async with AsyncSessionLocal() as session:
+    async with _use_session(db) as session:
         result = await session.execute(
-            select(AudioChunk).where(
+            select(AudioChunk)
+            .options(undefer(AudioChunk.audio_blob))  # Returned for playback, so the audio comes along
+            .where(
                 and_(
                     AudioChunk.book_id == book_id,
                     AudioChunk.start_timestamp <= timestamp,
@@ -0,0 +1,17 @@
+import logging
+
+from app.db.database import engine
+from app.models.models import Base
+
+logger = logging.getLogger(__name__)
+
+# Run once per deploy rather than on import, so app workers start without
+# each probing and locking the catalog with the same DDL.
+def create_schema() -> None:
+    """Creates the tables, indexes and triggers that are missing, existing ones are left as they are"""
+    Base.metadata.create_all(engine)
+    logger.info("Database schema is up to date")
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    create_schema()
@@ -1,32 +1,124 @@
 from abc import ABC, abstractmethod
-from typing import List, Optional, Tuple
+import asyncio
+from functools import cache
+import hashlib
+import logging
+import re
+import threading
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
 import numpy as np
-from sqlalchemy import create_engine, func
-from sqlalchemy.orm import Session
-from openai import OpenAI
-from app.config import DATABASE_URL, OPENAI_API_KEY
+from sqlalchemy import bindparam, event, func, select, text
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from app.config import DATABASE_URL, EMBEDDING_CONCURRENCY
+from app.core.clock_cache import ClockCache
+from app.db.database import async_database_url
 from app.models.models import Page
+from app.services.openai_client import get_async_openai_client, get_openai_client
 import nltk
-from nltk.tokenize import sent_tokenize
-from contextlib import contextmanager
+from nltk.tokenize import PunktTokenizer
+from contextlib import asynccontextmanager
+from pgvector.asyncpg import register_vector
+
+logger = logging.getLogger(__name__)
+
+# A blank line, including one holding only whitespace, separates paragraphs
+_PARAGRAPH_RE = re.compile(r"\n\s*\n")
+_WORD_RE = re.compile(r"\S+")
+# Whitespace after sentence-ending punctuation, before a capital or a quote. Cruder than punkt
+# (it splits after "Mr.") but one pass in the regex engine instead of punkt's Python rules
+_SENTENCE_SPLIT_RE = re.compile(r"(?<=[.!?])\s+(?=[A-Z\"'])")
+
+def _split_sentences(text: str) -> List[str]:
+    return [sentence for sentence in _SENTENCE_SPLIT_RE.split(text.strip()) if sentence]
+
+# Loaded on first use rather than at import: punkt is only needed by "sentences-nltk", and a missing
+# model that can't be downloaded (offline) shouldn't stop the whole app from starting
+@cache
+def _punkt_tokenizer() -> PunktTokenizer:
+    # Only downloaded when missing, nltk.download checks with the server on every call otherwise
+    try:
+        nltk.data.find('tokenizers/punkt_tab')
+    except LookupError:
+        nltk.download('punkt_tab', quiet=True)
+    return PunktTokenizer('english')  # One instance tokenizes every page's paragraphs
+
+def _split_sentences_nltk(text: str) -> List[str]:
+    return _punkt_tokenizer().tokenize(text)
+
+# Chunking methods that window sentences, by how they find them
+_SENTENCE_SPLITTERS = {
+    "sentences": _split_sentences,
+    "sentences-nltk": _split_sentences_nltk,  # For text that needs punkt's accuracy
+}
+
+def quantize_int8(embeddings: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Symmetric int8 quantization of an (N, D) matrix, one scale per row.
+    Returns the int8 matrix and the scales, row i is approximately quantized[i] * scales[i]"""
+    scales = np.abs(embeddings).max(axis=1) / 127
+    scales[scales == 0] = 1  # All-zero rows stay zero
+    quantized = np.rint(embeddings / scales[:, None]).astype(np.int8)
+    return quantized, scales.astype(np.float32)
+
+def normalize(embeddings: np.ndarray) -> np.ndarray:
+    """Scales a vector, or each row of a matrix, to unit length so cosine similarity is a dot product"""
+    norms = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+    norms[norms == 0] = 1  # All-zero rows stay zero
+    return embeddings / norms
+
+def dequantize_int8(quantized: bytes, scale: float) -> np.ndarray:
+    return np.frombuffer(quantized, dtype=np.int8).astype(np.float32) * scale
+
+# OpenAI caps one embeddings request at 2048 inputs and 300k tokens
+MAX_EMBED_BATCH_TEXTS = 2048
+MAX_EMBED_BATCH_TOKENS = 250_000  # Headroom, tokens are estimated rather than counted
+CHARS_PER_TOKEN = 3  # English averages about 4, estimating low keeps batches under the cap
+
+def _embedding_batches(texts: List[str]) -> Iterator[List[str]]:
+    """Groups texts, in order, into as few requests as the API's input and token caps allow"""
+    batch, batch_tokens = [], 0
+    for item in texts:
+        tokens = len(item) // CHARS_PER_TOKEN + 1
+        if batch and (len(batch) >= MAX_EMBED_BATCH_TEXTS or batch_tokens + tokens > MAX_EMBED_BATCH_TOKENS):
+            yield batch
+            batch, batch_tokens = [], 0
+        batch.append(item)
+        batch_tokens += tokens
+    if batch:
+        yield batch
+
+QUERY_EMBEDDING_CACHE_SIZE = 4096
+
+# Shared by every embedder so concurrent uploads together stay under OpenAI's rate limits
+_embedding_semaphore = asyncio.Semaphore(EMBEDDING_CONCURRENCY)
 
-nltk.download('punkt_tab')
 class TextEmbedder(ABC):
     @abstractmethod
     def embed_text(self, text: str) -> np.ndarray:
         pass
 
+    @abstractmethod
+    def embed_texts(self, texts: List[str]) -> np.ndarray:
+        pass
+
+    @abstractmethod
+    async def aembed_texts(self, texts: List[str]) -> np.ndarray:
+        pass
+
     @abstractmethod
     def chunk_text(self, text: str) -> List[str]:
         pass
 
 class VectorDatabase(ABC):
     @abstractmethod
-    def similarity_search(self, query_vector: np.ndarray, limit: int = 5) -> List[Tuple[float, str]]:
+    async def similarity_search(self, query_vector: np.ndarray, limit: int = 5) -> List[Tuple[float, str]]:
         pass
 
     @abstractmethod
-    def hybrid_search(self, query_text: str, query_vector: np.ndarray, limit: int = 5) -> List[Tuple[float, str]]:
+    async def hybrid_search(self, query_text: str, query_vector: np.ndarray, limit: int = 5) -> List[Tuple[float, str]]:
+        pass
+
+    @abstractmethod
+    async def rrf_search(self, book_id: str, query_text: str, query_vector: Optional[np.ndarray] = None, limit: int = 10) -> List[Tuple[float, int, List[str]]]:
         pass
 
 # USING OPENAI EMBEDDINGS FOR SIMPLICTY
@@ -34,89 +126,334 @@ class VectorDatabase(ABC):
 # Either creating our own service or using managed endpoint. Multilanguage support will also be needed.
 class OpenAIEmbedder(TextEmbedder):
     def __init__(self, model="text-embedding-3-small"):
-        self.client = OpenAI(api_key=OPENAI_API_KEY)
+        self.client = get_openai_client()
+        self.aclient = get_async_openai_client()
         self.model = model
+        # Single texts are mostly search queries, which repeat (autocomplete, polling),
+        # a repeat skips the round trip to OpenAI. Keyed per embedder, so per model
+        self._query_cache = ClockCache(QUERY_EMBEDDING_CACHE_SIZE)
+        self._query_cache_lock = threading.Lock()  # Hits are lock-free, inserts may come from worker threads
+        self._query_requests: Dict[bytes, asyncio.Task] = {}  # Misses being embedded, by cache key
         
     def embed_text(self, text: str) -> np.ndarray:
-        response = self.client.embeddings.create(
-            model=self.model,
-            input=text
-        )
-        print(text)
-        print(response.data[0].embedding)
-        print(len(response.data[0].embedding))
-        return np.array(response.data[0].embedding)
+        text = _normalize_query(text)
+        key = self._query_key(text)
+        embedding = self._query_cache.get(key)
+        if embedding is None:
+            embedding = self._remember_query(key, self.embed_texts([text])[0])
+        return embedding
+
+    async def aembed_text(self, text: str) -> np.ndarray:
+        text = _normalize_query(text)
+        key = self._query_key(text)
+        embedding = self._query_cache.get(key)
+        if embedding is not None:
+            return embedding
+        # Concurrent misses for the same query (a search fired twice, polling) share one request
+        request = self._query_requests.get(key)
+        if request is None:
+            request = asyncio.create_task(self._aembed_query(key, text))
+            self._query_requests[key] = request
+            request.add_done_callback(lambda _: self._query_requests.pop(key, None))
+        return await asyncio.shield(request)  # One caller giving up doesn't cancel it for the others
+
+    async def _aembed_query(self, key: bytes, text: str) -> np.ndarray:
+        return self._remember_query(key, (await self.aembed_texts([text]))[0])
+
+    def _query_key(self, text: str) -> bytes:
+        # A fixed-size digest rather than the text itself, so long queries don't bloat the cache
+        return hashlib.blake2b(text.encode(), digest_size=16).digest()
+
+    def _remember_query(self, key: bytes, embedding: np.ndarray) -> np.ndarray:
+        embedding.setflags(write=False)  # Handed to every caller asking for the same text
+        with self._query_cache_lock:
+            self._query_cache.put(key, embedding)
+        return embedding
+
+    def embed_texts(self, texts: List[str]) -> np.ndarray:
+        """Embeds many texts with one API call per batch instead of one per text.
+        Returns an (N, D) float32 matrix, one row per text in input order"""
+        embeddings = []
+        for batch in _embedding_batches(texts):
+            response = self.client.embeddings.create(
+                model=self.model,
+                input=batch
+            )
+            embeddings.extend(d.embedding for d in sorted(response.data, key=lambda d: d.index))
+        # One conversion for the whole matrix instead of an array per text
+        return normalize(np.array(embeddings, dtype=np.float32))
+
+    async def aembed_texts(self, texts: List[str]) -> np.ndarray:
+        """Like embed_texts, but sends the batches concurrently, without blocking the event loop"""
+        # A failed batch cancels the rest rather than paying for embeddings we drop
+        async with asyncio.TaskGroup() as group:
+            tasks = [group.create_task(self._aembed_batch(batch)) for batch in _embedding_batches(texts)]
+        return normalize(np.array([embedding for task in tasks for embedding in task.result()], dtype=np.float32))
+
+    async def _aembed_batch(self, batch: List[str]) -> List[List[float]]:
+        async with _embedding_semaphore:
+            response = await self.aclient.embeddings.create(
+                model=self.model,
+                input=batch
+            )
+        return [d.embedding for d in sorted(response.data, key=lambda d: d.index)]
 
     def chunk_text(self, text: str, method: str = "sentences", **kwargs) -> List[str]:
-        if method == "sentences":
-            return self._chunk_by_sentences(text, **kwargs)
+        if method in _SENTENCE_SPLITTERS:
+            return self._chunk_by_sentences(text, split=_SENTENCE_SPLITTERS[method], **kwargs)
         elif method == "words":
             return self._chunk_by_words(text, **kwargs)
         return self._chunk_by_paragraph(text)
 
-    def _chunk_by_sentences(self, text: str, window_size: int = 3) -> List[str]:
-        sentences = sent_tokenize(text)
-        chunks = []
-        
-        for i in range(0, len(sentences), window_size):
-            chunk = " ".join(sentences[i:i + window_size])
-            chunks.append(chunk)
+    def chunk_text_multi(self, text: str, methods: Tuple[str, ...] = ("paragraphs", "sentences"), window_size: int = 3) -> Dict[str, List[str]]:
+        """Chunks text at several levels off one paragraph split, sentences are tokenized
+        paragraph by paragraph instead of re-scanning the whole text"""
+        paragraphs = self._chunk_by_paragraph(text)
+        chunks = {}
+        if "paragraphs" in methods:
+            chunks["paragraphs"] = paragraphs
+        for method in methods:
+            if method in _SENTENCE_SPLITTERS:
+                split = _SENTENCE_SPLITTERS[method]
+                sentences = [sentence for paragraph in paragraphs for sentence in split(paragraph)]
+                chunks[method] = self._window_sentences(sentences, window_size)
         return chunks
 
+    def _chunk_by_sentences(self, text: str, window_size: int = 3, split: Callable[[str], List[str]] = _split_sentences) -> List[str]:
+        return self._window_sentences(split(text), window_size)
+
+    def _window_sentences(self, sentences: List[str], window_size: int) -> List[str]:
+        return [" ".join(sentences[i:i + window_size]) for i in range(0, len(sentences), window_size)]
+
     def _chunk_by_words(self, text: str, chunk_size: int = 500, overlap: int = 100) -> List[str]:
-        words = text.split()
-        chunks = []
-        
-        for i in range(0, len(words), chunk_size - overlap):
-            chunk = " ".join(words[i:i + chunk_size])
-            if chunk:
-                chunks.append(chunk)
-        return chunks
+        # Word offsets from one regex scan, each chunk is then a single slice of the text
+        # from its first word's start to its last word's end, not a join of its words
+        spans = [match.span() for match in _WORD_RE.finditer(text)]
+        return [
+            text[spans[i][0]:spans[min(i + chunk_size, len(spans)) - 1][1]]
+            for i in range(0, len(spans), chunk_size - overlap)
+        ]
 
     def _chunk_by_paragraph(self, text: str) -> List[str]:
-        paragraphs = text.split('\n\n')
-        return [p.strip() for p in paragraphs if p.strip()]
+        return [p for p in map(str.strip, _PARAGRAPH_RE.split(text)) if p]
+
 
+def _normalize_query(text: str) -> str:
+    # Whitespace doesn't change what a query means, so it shouldn't change its cache entry.
+    # Case is kept, it can (names, acronyms)
+    return " ".join(text.split())
+
+def _rrf(rank):
+    # In floating point, integer ranks would make the division numeric and come back as Decimal
+    return 1.0 / (rank + float(RRF_K))
+
+def _as_embedding(query_vector: np.ndarray):
+    # Bound as a parameter of the column's halfvec type rather than cast from a text literal in the SQL,
+    # drivers with the binary vector codec send it as-is and the statement text stays the same across
+    # queries, so it is prepared once per connection. Callers keep passing float32 arrays
+    return bindparam('query_vector', normalize(np.asarray(query_vector, dtype=np.float32)), type_=Page.embedding.type)
+
+# Candidates the HNSW scan keeps per query, more is better recall for slower searches.
+# Searches size it per query from their limit, this is the connection default for anything else
+HNSW_EF_SEARCH = 100
+HNSW_EF_SEARCH_MIN = 40
+HNSW_INDEX_NAME = 'pages_embedding_hnsw'
+MIN_PGVECTOR_VERSION = (0, 7)  # First with halfvec, and SIMD-dispatched distance functions
+# Nearest pages hybrid_search fetches per requested result before filtering them by text
+HYBRID_OVERSAMPLE = 10
+# Queries with this many words match few enough pages that ranking all the matches is cheaper
+SELECTIVE_QUERY_TERMS = 3
+# Reciprocal Rank Fusion: each ranking contributes 1 / (RRF_K + rank) for its top RRF_CANDIDATES pages
+RRF_K = 60
+RRF_CANDIDATES = 100
 
 class PGVectorDB(VectorDatabase):
     def __init__(self, db_url: str):
         self.db_url = db_url
-        self.engine = create_engine(db_url)
+        # Async, so concurrent searches overlap their index scans on pooled connections
+        # instead of each blocking the event loop
+        self.engine = create_async_engine(
+            async_database_url(db_url),
+            pool_size=20,
+            max_overflow=10,
+            pool_pre_ping=True
+        )
+        event.listen(self.engine.sync_engine, 'connect', _on_connect)
+        self.sessionmaker = async_sessionmaker(self.engine, expire_on_commit=False)
+        self.ef_search = HNSW_EF_SEARCH_MIN  # Floor for per-query ef_search, raised by ensure_index on big tables
 
-    @contextmanager
-    def get_session(self) -> Session:
-        session = Session(self.engine)
-        try:
+    @asynccontextmanager
+    async def get_session(self) -> AsyncSession:
+        async with self.sessionmaker() as session:
             yield session
-        finally:
-            session.close()
-
-    def similarity_search(self, query_vector: np.ndarray, limit: int = 5) -> List[Tuple[float, str]]:
-        with self.get_session() as session:
-            results = (
-                session.query(
-                    func.cosine_similarity(Page.embedding, query_vector).label('similarity'),
-                    Page.paragraphed_text
-                )
-                .order_by(func.cosine_similarity(Page.embedding, query_vector).desc())
+
+    async def similarity_search(self, query_vector: np.ndarray, limit: int = 5, ef_search: Optional[int] = None) -> List[Tuple[float, str]]:
+        # Embeddings are unit length, so pgvector's <#> negative inner product ranks like cosine distance
+        # without a norm per row. Ordered ascending so the HNSW index serves the ORDER BY, and by
+        # the label so the distance is evaluated once per row rather than twice.
+        # asyncpg already returns the distance as a float, rows are unpacked as they are fetched
+        distance = Page.embedding.max_inner_product(_as_embedding(query_vector)).label('distance')
+        async with self.get_session() as session:
+            await _set_ef_search(session, ef_search or max(self.ef_search, limit * 8))
+            result = await session.execute(
+                select(distance, Page.paragraphed_text)
+                .order_by(distance)
                 .limit(limit)
-                .all()
             )
-            return [(float(r[0]), r[1]) for r in results]
-
-    def hybrid_search(self, query_text: str, query_vector: np.ndarray, limit: int = 5) -> List[Tuple[float, str]]:
-        with self.get_session() as session:
-            results = (
-                session.query(
-                    func.cosine_similarity(Page.embedding, query_vector).label('similarity'),
-                    Page.paragraphed_text
+            return [(-distance, paragraphs) for distance, paragraphs in result]
+
+    async def hybrid_search(self, query_text: str, query_vector: np.ndarray, limit: int = 5, oversample: int = HYBRID_OVERSAMPLE, ef_search: Optional[int] = None) -> List[Tuple[float, str]]:
+        """
+        Pages matching query_text, nearest to query_vector first. A text filter in front of the
+        HNSW ORDER BY leaves the planner either post-filtering an index scan down to fewer than
+        limit rows or falling back to a full scan, so the two are planned explicitly:
+        broad queries take the limit * oversample nearest pages and filter those by text,
+        selective ones match the text through its GIN index first and rank the matches exactly.
+        ef_search only applies to the former, it defaults to twice the oversampled candidates
+        """
+        query_vector = _as_embedding(query_vector)
+        ts_query = func.plainto_tsquery('english', query_text)
+        uses_index = len(query_text.split()) < SELECTIVE_QUERY_TERMS
+        if not uses_index:
+            # MATERIALIZED keeps the HNSW index out of the ranking, it would post-filter again
+            candidates = (
+                select(Page.paragraphed_text, Page.embedding)
+                .where(Page.text_search.op('@@')(ts_query))
+                .cte('candidates')
+                .prefix_with('MATERIALIZED')
+            )
+            distance = candidates.c.embedding.max_inner_product(query_vector).label('distance')
+            stmt = select(distance, candidates.c.paragraphed_text)
+        else:
+            nearest = (
+                select(
+                    Page.embedding.max_inner_product(query_vector).label('distance'),
+                    Page.paragraphed_text,
+                    Page.text_search
                 )
-                .filter(Page.text_search.op('@@')(func.plainto_tsquery('english', query_text)))
-                .order_by(func.cosine_similarity(Page.embedding, query_vector).desc())
-                .limit(limit)
-                .all()
+                .order_by('distance')
+                .limit(limit * oversample)
+                .cte('candidates')
+            )
+            distance = nearest.c.distance
+            stmt = (
+                select(distance, nearest.c.paragraphed_text)
+                .where(nearest.c.text_search.op('@@')(ts_query))
+            )
+        async with self.get_session() as session:
+            if uses_index:
+                # The scan returns at most ef_search pages, it has to cover every candidate
+                await _set_ef_search(session, ef_search or max(self.ef_search, limit * oversample * 2))
+            result = await session.execute(stmt.order_by(distance).limit(limit))
+            return [(-distance, paragraphs) for distance, paragraphs in result]
+
+    async def rrf_search(self, book_id: str, query_text: str, query_vector: Optional[np.ndarray] = None, limit: int = 10, candidates: int = RRF_CANDIDATES) -> List[Tuple[float, int, List[str]]]:
+        """
+        Pages of a book ranked by Reciprocal Rank Fusion of full-text rank and embedding distance,
+        best first, as (score, page_number, paragraphs). Fused in one query, so both rankings and
+        the merge cost a single round-trip. Without query_vector only the text ranking is used
+        """
+        ts_query = func.plainto_tsquery('english', query_text)
+        lexical_rank = func.ts_rank_cd(Page.text_search, ts_query)
+        lexical = (
+            select(Page.id, func.row_number().over(order_by=lexical_rank.desc()).label('rank'))
+            .where(Page.book_id == book_id, Page.text_search.op('@@')(ts_query))
+            .order_by(lexical_rank.desc())
+            .limit(candidates)
+            .cte('lexical')
+        )
+        if query_vector is None:
+            score = _rrf(lexical.c.rank).label('score')
+            stmt = select(score, Page.page_number, Page.paragraphed_text).join(Page, Page.id == lexical.c.id)
+        else:
+            # A book's pages are few enough to rank exactly. MATERIALIZED keeps the HNSW index, which
+            # would post-filter the whole library by book, out of it
+            book_pages = (
+                select(Page.id, Page.embedding.max_inner_product(_as_embedding(query_vector)).label('distance'))
+                .where(Page.book_id == book_id)
+                .cte('book_pages')
+                .prefix_with('MATERIALIZED')
+            )
+            semantic = (
+                select(book_pages.c.id, func.row_number().over(order_by=book_pages.c.distance).label('rank'))
+                .order_by(book_pages.c.distance)
+                .limit(candidates)
+                .cte('semantic')
+            )
+            # Pages found by only one ranking score nothing for the other
+            score = (
+                func.coalesce(_rrf(lexical.c.rank), 0.0)
+                + func.coalesce(_rrf(semantic.c.rank), 0.0)
+            ).label('score')
+            fused = lexical.join(semantic, lexical.c.id == semantic.c.id, full=True)
+            stmt = (
+                select(score, Page.page_number, Page.paragraphed_text)
+                .select_from(fused)
+                .join(Page, Page.id == func.coalesce(lexical.c.id, semantic.c.id))
             )
-            return [(float(r[0]), r[1]) for r in results]
+        async with self.get_session() as session:
+            result = await session.execute(stmt.order_by(score.desc()).limit(limit))
+            return [tuple(row) for row in result]
+
+    async def ensure_index(self, rebuild: bool = False) -> Dict[str, int]:
+        """
+        Creates the pages HNSW index with parameters sized to the table, or with rebuild,
+        recreates it when the table has outgrown the ones it was built with. Builds run
+        CONCURRENTLY so searches and uploads carry on meanwhile. Fails when the database's pgvector
+        is too old for the halfvec column. Returns the parameters used
+        """
+        async with self.engine.connect() as conn:
+            # CREATE INDEX CONCURRENTLY can't run inside a transaction
+            conn = await conn.execution_options(isolation_level='AUTOCOMMIT')
+            version = (await conn.execute(
+                text("SELECT extversion FROM pg_extension WHERE extname = 'vector'")
+            )).scalar()
+            if version is None or tuple(int(part) for part in version.split('.')[:2]) < MIN_PGVECTOR_VERSION:
+                raise RuntimeError(f"pgvector {version} is installed, halfvec and its SIMD distances need 0.7+")
+            vector_count = (await conn.execute(
+                text("SELECT reltuples::bigint FROM pg_class WHERE relname = 'pages'")
+            )).scalar() or 0
+            params = configure_hnsw_params(vector_count)
+            self.ef_search = params['ef_search']
+
+            options = (await conn.execute(
+                text("SELECT reloptions FROM pg_class WHERE relname = :name"), {'name': HNSW_INDEX_NAME}
+            )).scalar()
+            wanted = [f"m={params['m']}", f"ef_construction={params['ef_construction']}"]
+            if options is not None and (not rebuild or sorted(options) == sorted(wanted)):
+                return params
+
+            logger.info("Building %s for ~%d pages with %s", HNSW_INDEX_NAME, vector_count, params)
+            await conn.execute(text("SET maintenance_work_mem = '2GB'"))
+            await conn.execute(text("SET max_parallel_maintenance_workers = 7"))
+            if options is not None:
+                await conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {HNSW_INDEX_NAME}"))
+            await conn.execute(text(
+                f"CREATE INDEX CONCURRENTLY {HNSW_INDEX_NAME} ON pages USING hnsw (embedding halfvec_ip_ops) "
+                f"WITH (m = {params['m']}, ef_construction = {params['ef_construction']})"
+            ))
+        return params
+
+def configure_hnsw_params(vector_count: int) -> Dict[str, int]:
+    """HNSW build and search parameters for a table of vector_count vectors. Bigger graphs need
+    more links per node and wider searches to keep recall, small ones build faster without"""
+    if vector_count < 100_000:
+        return {'m': 16, 'ef_construction': 64, 'ef_search': 40}
+    if vector_count < 1_000_000:
+        return {'m': 24, 'ef_construction': 128, 'ef_search': 100}
+    return {'m': 32, 'ef_construction': 256, 'ef_search': 200}
+
+async def _set_ef_search(session: AsyncSession, ef_search: int) -> None:
+    # Local to the session's transaction so it doesn't leak to the connection's next user.
+    # SET can't take a bound parameter, set_config can
+    await session.execute(select(func.set_config('hnsw.ef_search', str(ef_search), True)))
+
+async def _prepare_connection(connection) -> None:
+    await register_vector(connection)
+    await connection.execute(f"SET hnsw.ef_search = {HNSW_EF_SEARCH}")
+
+def _on_connect(dbapi_connection, connection_record):
+    dbapi_connection.run_async(_prepare_connection)
 
 # Singleton instances
 _openai_embedder = None
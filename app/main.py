@@ -1,18 +1,29 @@
-from fastapi import Depends, FastAPI, File, Response, UploadFile, WebSocket, HTTPException
+import asyncio
+from contextlib import aclosing, asynccontextmanager, suppress
+import logging
+import time
+from fastapi import BackgroundTasks, Depends, FastAPI, File, Response, UploadFile, WebSocket, WebSocketDisconnect, HTTPException, status
 from fastapi.middleware.cors import CORSMiddleware
-from app.core.reader import OpenAISynthTranscriber
-from app.services.authentication import ACCESS_TOKEN_EXPIRE_MINUTES, SECRET_KEY, router as auth_router, get_current_user
-from app.models.models import Book, User
+from fastapi.responses import RedirectResponse
+from app.core.reader import get_synth
+from app.services.authentication import ACCESS_TOKEN_EXPIRE_MINUTES, SECRET_KEY, router as auth_router, get_current_user, CurrentUser
+from app.models.models import Book
 from starlette.middleware.sessions import SessionMiddleware
 from pathlib import Path
-from app.core.upload_processing import process_pdf_upload, save_uploaded_file
-from app.db.database import get_book_with_state, update_reading_position, get_user_books
+from app.core.upload_processing import ingest_pdf_pages, register_pdf_upload, save_uploaded_file
+from app.core.clock_cache import ClockCache
+from app.core.position_writer import get_position_writer
+from app.db.database import get_book_with_state, get_merged_book_id, get_user_book_state_id, stream_audio_chunks, get_user_books
+from app.db.vector_database import get_embedder, get_vector_db
 
 from app.config import FRONTEND_URL
 
 from typing import Dict, List, Literal, Optional
+from uuid import UUID
 from pydantic import BaseModel
 
+logger = logging.getLogger(__name__)
+
 class ReadingPosition(BaseModel):
     page: int
     paragraph: int
@@ -29,6 +40,7 @@ class BookMetadata(BaseModel):
     id: str
     total_pages: int
     table_of_contents: Dict[str, ChapterPosition]
+    ingest_status: str  # pending until the pages are searchable and narratable, then ready or failed
 
 # Actually think speedup should be handled on the client
 # and we should just send the current position to the server
@@ -51,12 +63,24 @@ class NavigationTarget(BaseModel):
     value: str
 
 class SearchQuery(BaseModel):
-    book_id: str
+    book_id: UUID
     query: str
     type: Literal['text', 'semantic']
     scope: Optional[dict]
 
-app = FastAPI()
+class SearchResult(BaseModel):
+    page_number: int
+    score: float
+    paragraphs: List[str]
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    position_writer = get_position_writer()
+    position_writer.start()
+    yield
+    await position_writer.stop()  # Writes whatever positions are still buffered
+
+app = FastAPI(lifespan=lifespan)
 app.include_router(auth_router, prefix="/auth", tags=["authentication"])
 
 app.add_middleware(
@@ -75,6 +99,14 @@ app.add_middleware(
 
 # Create upload directory constant
 UPLOAD_DIR = Path("uploads")
+NARRATION_PREFETCH_CHUNKS = 2  # Audio chunks read ahead of the one being sent
+SEARCH_RESULTS = 10
+OWNED_BOOKS_CACHE_SIZE = 16384
+OWNED_BOOKS_CACHE_TTL = 60  # Seconds a reader's state for a book is trusted without querying it again
+
+# Readers checked to have a state for a book, so position updates several times a second
+# don't each query for it
+_owned_books = ClockCache(OWNED_BOOKS_CACHE_SIZE)  # (user id, book id) -> trusted until
 
 @app.get("/")
 async def root():
@@ -86,73 +118,93 @@ async def health():
 
 @app.post("/api/books/upload", response_model=BookMetadata)
 async def upload_book(
+    background_tasks: BackgroundTasks,
     file: UploadFile = File(...),
-    current_user: User = Depends(get_current_user)
+    current_user: CurrentUser = Depends(get_current_user)
 ):
     if not file.filename.lower().endswith('.pdf'):
         raise HTTPException(status_code=400, detail="Only PDF files are allowed")
     
     try:
-        content = await file.read()
-        file_path = save_uploaded_file(content, file.filename, UPLOAD_DIR)
-        metadata = await process_pdf_upload(file_path, current_user.id)
-        print(metadata)
+        # Copy the spooled upload in chunks rather than holding the whole PDF in memory
+        file_path, _, content_hash = await asyncio.to_thread(save_uploaded_file, file.file, file.filename, UPLOAD_DIR)
+        metadata, is_new = await register_pdf_upload(file_path, current_user.id, content_hash=content_hash)
+        if is_new:
+            # Answered from the outline alone, the pages are extracted and embedded after the response
+            background_tasks.add_task(ingest_pdf_pages, metadata['id'], file_path, metadata['total_pages'], current_user.id)
+        logger.debug("Uploaded book: %s", metadata['id'])
         return metadata
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/books/list", response_model=List[BookMetadata])
 async def list_books(
-    current_user: User = Depends(get_current_user)
+    current_user: CurrentUser = Depends(get_current_user)
 ):
-    books = await get_user_books(current_user.id)
-    return [
-        BookMetadata(
-            reference_string=book.reference_string,
-            id=str(book.id),
-            total_pages=book.total_pages,
-            table_of_contents=book.table_of_contents
-        ) for book in books
-    ]
+    # Validated and serialized once, by the response model
+    return await get_user_books(current_user.id)
+
+async def _book_not_found(route: str, book_id: UUID) -> RedirectResponse:
+    """Redirects to the same route of the book this one was merged into, a 404 if it wasn't merged"""
+    merged_into = await get_merged_book_id(str(book_id))
+    if merged_into is None:
+        raise HTTPException(status_code=404, detail="Book not found")
+    # 308 keeps the method and body, so position updates follow it too
+    return RedirectResponse(app.url_path_for(route, book_id=merged_into), status_code=308)
 
 @app.get("/api/books/{book_id}", response_model=BookMetadata)
 async def get_book(
-    book_id: str,
-    current_user: User = Depends(get_current_user)
+    book_id: UUID,
+    current_user: CurrentUser = Depends(get_current_user)
 ):
     result = await get_book_with_state(book_id, current_user.id)
     if not result:
-        raise HTTPException(status_code=404, detail="Book not found")
+        return await _book_not_found("get_book", book_id)
     book, _ = result
     return BookMetadata(
         reference_string=book.reference_string,
         id=str(book.id),
         total_pages=book.total_pages,
-        table_of_contents=book.table_of_contents
+        table_of_contents=book.table_of_contents,
+        ingest_status=book.ingest_status
     )
 
 @app.get("/api/books/{book_id}/position", response_model=ReadingPosition)
 async def get_reading_position(
-    book_id: str,
-    current_user: User = Depends(get_current_user)
+    book_id: UUID,
+    current_user: CurrentUser = Depends(get_current_user)
 ):
     result = await get_book_with_state(book_id, current_user.id)
     if not result:
-        raise HTTPException(status_code=404, detail="Book not found")
+        return await _book_not_found("get_reading_position", book_id)
     _, state = result
-    if not state.cursor_position:
+    # A position reported moments ago may not be written yet
+    cursor_position = get_position_writer().get(current_user.id, state.book_id) or state.cursor_position
+    if not cursor_position:
         return ReadingPosition(page=1, paragraph=0, sentence=0, timestamp=0.0)
-    return ReadingPosition(**state.cursor_position)
+    return ReadingPosition(**cursor_position)
+
+async def _owns_book(user_id: str, book_id: str) -> bool:
+    key = (user_id, book_id)
+    trusted_until = _owned_books.get(key)
+    if trusted_until is not None and trusted_until > time.monotonic():
+        return True
+    if await get_user_book_state_id(user_id, book_id) is None:
+        return False
+    _owned_books.put(key, time.monotonic() + OWNED_BOOKS_CACHE_TTL)
+    return True
 
 @app.post("/api/books/{book_id}/position")
 async def set_reading_position(
-    book_id: str,
+    book_id: UUID,
     position: ReadingPosition,
-    current_user: User = Depends(get_current_user)
+    current_user: CurrentUser = Depends(get_current_user)
 ):
-    state = await update_reading_position(current_user.id, book_id, position.dict())
-    if not state:
-        raise HTTPException(status_code=404, detail="Book not found")
+    # Only books the reader has a state for, anything else would just sit in the writer's buffer
+    if not await _owns_book(current_user.id, str(book_id)):
+        return await _book_not_found("set_reading_position", book_id)
+    # Buffered and written with everyone else's within POSITION_FLUSH_INTERVAL, only the latest counts
+    get_position_writer().set(current_user.id, str(book_id), position.dict())
     return {"status": "success"}
 
 # potentially don't stream, but send buffer and let the client handle pacing
@@ -160,24 +212,68 @@ async def set_reading_position(
 @app.websocket("/api/narration/stream/{book_id}")
 async def narration_stream(
     websocket: WebSocket,
-    book_id: str,
-    position: Optional[ReadingPosition] = None # if None, start from the beginning
+    book_id: UUID,
+    timestamp: float = 0.0  # Where to start, the beginning by default
 ):
+    # Same cookie and ownership checks as the book routes, refused before the handshake completes
+    try:
+        current_user = await get_current_user(websocket.cookies.get("session_token"))
+    except HTTPException:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    if not await get_book_with_state(book_id, current_user.id):
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+
     await websocket.accept()
-    pass
+    # The next chunks are read from the database while the current one is being sent
+    chunks = asyncio.Queue(maxsize=NARRATION_PREFETCH_CHUNKS)
+
+    async def read_chunks():
+        # The end marker is only put by a reader that is still running, a cancelled one
+        # must not park in put() on a full queue nobody drains any more
+        try:
+            async with aclosing(stream_audio_chunks(book_id, timestamp)) as stream:
+                async for chunk in stream:
+                    await chunks.put(chunk)
+        except Exception:
+            await chunks.put(None)  # Wakes the sender, awaiting the reader then raises this
+            raise
+        await chunks.put(None)
+
+    reader = asyncio.create_task(read_chunks())
+    try:
+        while (chunk := await chunks.get()) is not None:
+            # Audio goes out as raw binary frames, its timestamps follow in a small JSON frame of their own
+            await websocket.send_bytes(chunk.audio_blob)
+            await websocket.send_json({
+                'seq': chunk.sequence_number,
+                'start_timestamp': chunk.start_timestamp,
+                'end_timestamp': chunk.end_timestamp
+            })
+        await reader  # Surfaces a failed read instead of ending the stream as if the book were done
+    except WebSocketDisconnect:
+        logger.debug("Narration stream for %s closed by the client", book_id)
+        return
+    finally:
+        # Waits for the reader to unwind, closing its session and server-side cursor
+        reader.cancel()
+        with suppress(asyncio.CancelledError):
+            await reader
+    await websocket.close()
 
 @app.post("/api/narration/pause")
 async def pause_narration(
-    book_id: str,
+    book_id: UUID,
     position: ReadingPosition,
-    current_user: User = Depends(get_current_user)
+    current_user: CurrentUser = Depends(get_current_user)
 ):
     pass
 
 @app.post("/api/chat/ask")
 async def ask_question(
     question: QuestionCreate,
-    current_user: User = Depends(get_current_user)
+    current_user: CurrentUser = Depends(get_current_user)
 ):
     pass
 
@@ -189,38 +285,46 @@ async def ask_question(
 @app.post("/api/bookmarks", response_model=dict)
 async def create_bookmark(
     bookmark: BookmarkCreate,
-    current_user: User = Depends(get_current_user)
+    current_user: CurrentUser = Depends(get_current_user)
 ):
     pass
 
 @app.get("/api/bookmarks/{book_id}")
 async def get_bookmarks(
-    book_id: str,
+    book_id: UUID,
     user_id: str,
-    current_user: User = Depends(get_current_user)
+    current_user: CurrentUser = Depends(get_current_user)
 ):
     pass
 
 @app.post("/api/navigation/jump")
 async def jump_to_position(
     target: NavigationTarget,
-    book_id: str,
-    current_user: User = Depends(get_current_user)
+    book_id: UUID,
+    current_user: CurrentUser = Depends(get_current_user)
 ):
     pass
 
-@app.post("/api/search")
+@app.post("/api/search", response_model=List[SearchResult])
 async def search_book(
     search: SearchQuery,
-    current_user: User = Depends(get_current_user)
+    current_user: CurrentUser = Depends(get_current_user)
 ):
-    pass
+    if not await get_book_with_state(search.book_id, current_user.id):
+        raise HTTPException(status_code=404, detail="Book not found")
+    # Semantic search fuses the full-text and embedding rankings, text search ranks by text alone
+    query_vector = await get_embedder().aembed_text(search.query) if search.type == 'semantic' else None
+    results = await get_vector_db().rrf_search(search.book_id, search.query, query_vector, limit=SEARCH_RESULTS)
+    return [
+        {'score': score, 'page_number': page_number, 'paragraphs': paragraphs}
+        for score, page_number, paragraphs in results
+    ]
 
 
 @app.get("/api/test/synthesize")
 async def synthesize_text():
     import time
-    transcriber = OpenAISynthTranscriber()
+    transcriber = get_synth()
     OLD_MACDONALD = """Old MacDonald had a farm
                         Ee i ee i o
                         And on his farm he had some cows
@@ -254,18 +358,18 @@ async def synthesize_text():
                         Ee i ee i o \n\n"""
     FINAL_TEXT = OLD_MACDONALD + OLD_MACDONALD + OLD_MACDONALD + OLD_MACDONALD + OLD_MACDONALD + OLD_MACDONALD
     chars = len(FINAL_TEXT)
-    print(f"chars: {chars}")
+    logger.debug("chars: %d", chars)
     buffers = transcriber._convert_paragraph_text_to_buffers(FINAL_TEXT.split("\n\n"))
-    print("buffers", buffers)
+    logger.debug("buffers %s", buffers)
     sum_len = 0
-    print("len buffers", len(buffers))
+    logger.debug("len buffers %d", len(buffers))
     for buffer in buffers:
-        print("len buffer", len(buffer))
+        logger.debug("len buffer %d", len(buffer))
         sum_len += len(buffer)
     # start = time.time()
     # for buffer in buffers:
     #     content_bytes = transcriber._convert_text_to_audio(buffer)
     # end = time.time()
     # print(f"time: {end - start}")
-    print("sum_len", sum_len)
+    logger.debug("sum_len %d", sum_len)
     return {"status": "ok", "sum_len": sum_len}
\ No newline at end of file
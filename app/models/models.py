@@ -1,9 +1,8 @@
-from sqlalchemy import Boolean, create_engine, Column, Integer, String, DateTime, ForeignKey, Float, JSON, LargeBinary, ARRAY
-from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy import Boolean, Column, Integer, String, DateTime, ForeignKey, Float, JSON, LargeBinary, ARRAY
+from sqlalchemy.dialects.postgresql import TSVECTOR, UUID
 import sqlalchemy as sa
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship
-from app.config import DATABASE_URL
+from sqlalchemy.orm import deferred, relationship
 from datetime import datetime
 import uuid
 from sqlalchemy import event
@@ -11,30 +10,50 @@ from sqlalchemy.schema import DDL
 
 # Try to import pgvector, but don't fail if not available
 try:
-    from pgvector.sqlalchemy import Vector
+    from pgvector.sqlalchemy import HALFVEC, Vector
     HAS_PGVECTOR = True
+
+    class _NativeBind:
+        """On asyncpg numpy arrays are bound as-is and sent in binary by the vector codecs registered
+        on every connection, rather than formatted into a '[...]' text literal float by float"""
+        def bind_processor(self, dialect):
+            if dialect.driver == 'asyncpg':
+                return None
+            return super().bind_processor(dialect)
+
+    class NativeVector(_NativeBind, Vector):
+        cache_ok = True
+
+    class NativeHalfVector(_NativeBind, HALFVEC):
+        cache_ok = True
 except ImportError:
     HAS_PGVECTOR = False
-    Vector = lambda dim: sa.Column(JSON)  # Fallback to JSON type
+    Vector = lambda dim: JSON  # Fallback to JSON type
+    NativeVector = NativeHalfVector = Vector
 
 Base = declarative_base()
 
+# Keys are stored as native 16-byte uuid rather than 36 characters of text, so key indexes are
+# half the size. Python still sees plain strings, as_uuid=False converts on the way in and out
+UUIDString = UUID(as_uuid=False)
+
 class VerificationCode(Base):
     __tablename__ = "verification_codes"
     
-    id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
+    id = Column(UUIDString, primary_key=True, default=lambda: str(uuid.uuid4()))
     email = Column(String, index=True)
     code = Column(String)
     created_at = Column(DateTime, default=datetime.utcnow)
     expires_at = Column(DateTime)
     used = Column(Boolean, default=False)
-    user_id = Column(String, ForeignKey("users.id"))
+    attempts = Column(Integer, nullable=False, default=0, server_default='0')  # Verifications tried against it
+    user_id = Column(UUIDString, ForeignKey("users.id"))
     user = relationship("User", back_populates="verification_codes")
 
 class User(Base):
     __tablename__ = "users"
     
-    id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
+    id = Column(UUIDString, primary_key=True, default=lambda: str(uuid.uuid4()))
     email = Column(String, unique=True, nullable=False)
     name = Column(String, nullable=True)
     bio_info = Column(JSON)
@@ -44,25 +63,43 @@ class User(Base):
     book_states = relationship("UserBookState", back_populates="user")
     bookmarks = relationship("Bookmark", back_populates="user")
 
+# Book.ingest_status values. Uploads are answered before their pages are extracted and embedded,
+# so a book is pending until that finishes; a merged book's readers were moved to merged_into
+INGEST_PENDING = 'pending'
+INGEST_READY = 'ready'
+INGEST_FAILED = 'failed'
+INGEST_MERGED = 'merged'
+
 class Book(Base):
     __tablename__ = "books"
     
-    id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
+    id = Column(UUIDString, primary_key=True, default=lambda: str(uuid.uuid4()))
     reference_string = Column(String, nullable=False)
-    file_blob = Column(LargeBinary)
+    content_hash = Column(LargeBinary, unique=True)  # BLAKE2b of the PDF, so re-uploads reuse the book
+    minhash = Column(LargeBinary)  # MinHash signature of the text, for near-duplicate uploads
     total_pages = Column(Integer, nullable=False)
     table_of_contents = Column(JSON)  # Dictionary of chapter -> page range, timestamp
     created_at = Column(DateTime, default=datetime.utcnow)
+    ingest_status = Column(String, nullable=False, default=INGEST_READY, server_default=INGEST_READY)
+    merged_into = Column(UUIDString, ForeignKey("books.id"), nullable=True)  # Where a merged book's id now points
     
     pages = relationship("Page", back_populates="book")
     book_states = relationship("UserBookState", back_populates="book")
     audio_files = relationship("AudioChunk", back_populates="book")
 
+# The uploaded PDF, in a table of its own so the multi-MB blob stays out of books' rows and pages:
+# scans and lookups of book metadata never read or cache it
+class BookFile(Base):
+    __tablename__ = "book_files"
+
+    book_id = Column(UUIDString, ForeignKey("books.id"), primary_key=True)
+    file_blob = Column(LargeBinary, nullable=False)
+
 class Page(Base):
     __tablename__ = "pages"
     
-    id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
-    book_id = Column(String, ForeignKey("books.id"))
+    id = Column(UUIDString, primary_key=True, default=lambda: str(uuid.uuid4()))
+    book_id = Column(UUIDString, ForeignKey("books.id"))
     page_number = Column(Integer, nullable=False)
     chapter = Column(String)
     paragraphed_text = Column(ARRAY(String), nullable=False)  # Array of paragraphs
@@ -72,18 +109,35 @@ class Page(Base):
     audio_duration = Column(Float, nullable=True)   
     
     # Vector search columns - will store as JSON if pgvector not available
-    embedding = Vector(1536)  # OpenAI's embedding dimension
+    # OpenAI's embedding dimension, stored as float16: half the table and index size of a vector
+    # column, for a recall loss text-embedding-3-small doesn't notice
+    embedding = Column(NativeHalfVector(1536))
+    embedding_int8 = Column(LargeBinary)  # Same vector quantized to int8, a quarter of the size
+    embedding_scale = Column(Float)  # embedding ~= embedding_int8 * embedding_scale
     text_search = Column(TSVECTOR)
     chunk_embeddings = Column(JSON)  # Store chunk-level embeddings
     
     book = relationship("Book", back_populates="pages")
 
+    __table_args__ = (
+        sa.Index('ix_page_book_pageno', 'book_id', 'page_number', unique=True),  # Page ranges of a book
+        # Approximate nearest neighbours for ORDER BY embedding <#> query, instead of a scan of every page.
+        # Inner product, embeddings are normalized at ingest so it ranks like cosine
+        sa.Index(
+            'pages_embedding_hnsw', 'embedding',
+            postgresql_using='hnsw',
+            postgresql_with={'m': 24, 'ef_construction': 128},
+            postgresql_ops={'embedding': 'halfvec_ip_ops'}
+        ),
+        sa.Index('ix_pages_text_search', 'text_search', postgresql_using='gin'),  # Full-text matches
+    )
+
 class UserBookState(Base):
     __tablename__ = "user_book_states"
     
-    id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
-    user_id = Column(String, ForeignKey("users.id"))
-    book_id = Column(String, ForeignKey("books.id"))
+    id = Column(UUIDString, primary_key=True, default=lambda: str(uuid.uuid4()))
+    user_id = Column(UUIDString, ForeignKey("users.id"))
+    book_id = Column(UUIDString, ForeignKey("books.id"))
     cursor_position = Column(JSON)  # {page, paragraph, sentence, timestamp}
     last_accessed = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     voice_settings = Column(JSON)  # {speed, voice, etc.}
@@ -91,12 +145,17 @@ class UserBookState(Base):
     user = relationship("User", back_populates="book_states")
     book = relationship("Book", back_populates="book_states")
 
+    __table_args__ = (
+        sa.Index('ix_ubs_user_book', 'user_id', 'book_id', unique=True),  # One state per reader and book
+        sa.Index('ix_ubs_user_last', 'user_id', 'last_accessed'),  # A reader's library, most recent first
+    )
+
 class Bookmark(Base):
     __tablename__ = "bookmarks"
     
-    id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
-    user_id = Column(String, ForeignKey("users.id"))
-    book_id = Column(String, ForeignKey("books.id"))
+    id = Column(UUIDString, primary_key=True, default=lambda: str(uuid.uuid4()))
+    user_id = Column(UUIDString, ForeignKey("users.id"))
+    book_id = Column(UUIDString, ForeignKey("books.id"))
     position = Column(JSON)  # {page, paragraph, sentence}
     timestamp = Column(Float)
     note = Column(String)
@@ -107,9 +166,9 @@ class Bookmark(Base):
 class Question(Base):
     __tablename__ = "questions"
     
-    id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
-    user_id = Column(String, ForeignKey("users.id"))
-    book_id = Column(String, ForeignKey("books.id"))
+    id = Column(UUIDString, primary_key=True, default=lambda: str(uuid.uuid4()))
+    user_id = Column(UUIDString, ForeignKey("users.id"))
+    book_id = Column(UUIDString, ForeignKey("books.id"))
     question_text = Column(String, nullable=False)
     answer_text = Column(String)
     position = Column(JSON)  # Position when question was asked
@@ -118,14 +177,14 @@ class Question(Base):
 class AudioChunk(Base):
     __tablename__ = "audio_chunks"
     
-    id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
-    book_id = Column(String, ForeignKey("books.id"))
+    id = Column(UUIDString, primary_key=True, default=lambda: str(uuid.uuid4()))
+    book_id = Column(UUIDString, ForeignKey("books.id"))
     sequence_number = Column(Integer, nullable=False)
     start_page = Column(Integer, nullable=False)
     end_page = Column(Integer, nullable=False)
     start_timestamp = Column(Float, nullable=False)
     end_timestamp = Column(Float, nullable=False)
-    audio_blob = Column(LargeBinary)  # For direct DB storage
+    audio_blob = deferred(Column(LargeBinary))  # For direct DB storage, loaded only when playback asks for it
     
     book = relationship("Book", back_populates="audio_files")
 
@@ -133,7 +192,23 @@ class AudioChunk(Base):
         sa.Index('idx_book_timestamps', 'book_id', 'start_timestamp', 'end_timestamp'),
     )
 
-engine = create_engine(DATABASE_URL)
+# Page embeddings by text hash and model, so identical pages (title pages, boilerplate,
+# re-uploads with small edits) aren't sent to the embedding API again
+class EmbeddingCache(Base):
+    __tablename__ = "embedding_cache"
+
+    content_hash = Column(LargeBinary, primary_key=True)  # BLAKE2b of the page text
+    model = Column(String, primary_key=True)
+    embedding = Column(NativeVector(1536), nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+# LSH index over Book.minhash, one row per band of each book's signature
+class BookMinHashBand(Base):
+    __tablename__ = "book_minhash_bands"
+
+    band = Column(Integer, primary_key=True)
+    band_hash = Column(LargeBinary, primary_key=True)
+    book_id = Column(UUIDString, ForeignKey("books.id"), primary_key=True)
 
 # Actually allows us to use pgvector
 event.listen(
@@ -142,7 +217,7 @@ event.listen(
     DDL('CREATE EXTENSION IF NOT EXISTS vector;')
 )
 
-# Add this after all model definitions but before Base.metadata.create_all(engine)
+# Add this after all model definitions, the schema is created by app.db.init
 event.listen(
     Page.__table__,
     'after_create',
@@ -154,5 +229,3 @@ event.listen(
         """
     )
 )
-
-Base.metadata.create_all(engine)
\ No newline at end of file
@@ -1,27 +1,51 @@
 # main.py
+import asyncio
+import logging
 from fastapi import APIRouter, HTTPException, Depends, BackgroundTasks, Cookie
 from fastapi.security import OAuth2PasswordBearer
 from datetime import datetime, timedelta
 from typing import Optional
-from pydantic import BaseModel, EmailStr
+from pydantic import BaseModel, ConfigDict, EmailStr
 from sqlalchemy import select, update
 from app.models.models import User, VerificationCode
+import hashlib
 import jwt
 import secrets
+import time
 from email.message import EmailMessage
 import aiosmtplib
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+from cryptography.hazmat.primitives.serialization import load_pem_private_key
+from app.core.clock_cache import ClockCache
 from app.db.database import get_async_db, create_verification_code, get_valid_verification_code, get_user_by_email
 from fastapi.responses import JSONResponse
 
 from dotenv import load_dotenv
 import os
 
+logger = logging.getLogger(__name__)
+
 load_dotenv()
 
 SECRET_KEY = os.getenv("SECRET_KEY")
-ALGORITHM = "HS256"
+# Access tokens are signed with Ed25519 when a private key is configured (PEM, \n escapes allowed):
+# checking them then takes only the public key, so verifiers can't mint tokens.
+# Without one they fall back to HS256 with SECRET_KEY
+JWT_PRIVATE_KEY = os.getenv("JWT_PRIVATE_KEY")
+if JWT_PRIVATE_KEY:
+    ALGORITHM = "EdDSA"
+    # Parsed once into key objects, PyJWT would otherwise load the PEM again for every token
+    _signing_key = load_pem_private_key(JWT_PRIVATE_KEY.replace("\\n", "\n").encode(), password=None)
+    if not isinstance(_signing_key, Ed25519PrivateKey):
+        raise ValueError("JWT_PRIVATE_KEY must be an Ed25519 private key")
+    _verifying_key = _signing_key.public_key()
+else:
+    ALGORITHM = "HS256"
+    _signing_key = _verifying_key = SECRET_KEY
 EMAIL_VERIFICATION_TOKEN_EXPIRE_MINUTES = 60
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24  # 24 hours
+SESSION_CACHE_SIZE = 4096
+SESSION_CACHE_TTL = 60  # Seconds a verified token's user is served without decoding or querying again
 
 # Email settings
 SMTP_HOST = os.getenv("SMTP_HOST")
@@ -29,6 +53,7 @@ SMTP_PORT = os.getenv("SMTP_PORT")
 SMTP_USER = os.getenv("SMTP_USER")
 SMTP_PASSWORD = os.getenv("SMTP_PASSWORD")
 SMTP_FROM = os.getenv("SMTP_FROM")
+SMTP_POOL_SIZE = int(os.getenv("SMTP_POOL_SIZE", "2"))
 
 # Models
 class EmailVerification(BaseModel):
@@ -42,6 +67,15 @@ class Token(BaseModel):
     access_token: str
     token_type: str
 
+# The authenticated user as handed to routes and kept in the session cache: a frozen copy of the
+# plain columns rather than the User row, which would be shared (and mutable) across requests
+class CurrentUser(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
+    id: str
+    email: str
+    name: Optional[str] = None
+
 
 router = APIRouter()
 
@@ -53,33 +87,52 @@ async def send_verification_email(email: str, code: str):
     message["Subject"] = "Your Needle verification code"
     message.set_content(f"Your verification code is: {code}\nValid for {EMAIL_VERIFICATION_TOKEN_EXPIRE_MINUTES} minutes.")
 
-    smtp = aiosmtplib.SMTP(
-        hostname=os.getenv("SMTP_HOST"),
-        port=os.getenv("SMTP_PORT"),
-        use_tls=False,
-        timeout=10
-    )
-
+    pool = _get_smtp_pool()
+    smtp = await pool.get()
     try:
-        await smtp.connect()
-        await smtp.login(SMTP_USER, SMTP_PASSWORD)
-        await smtp.send_message(message)
-    except Exception as e:
-        print(f"Failed to send email: {e}")
+        try:
+            await _send_over(smtp, message)
+        except aiosmtplib.SMTPServerDisconnected:
+            # Servers drop connections that sat idle in the pool, retry once on a fresh one
+            smtp.close()
+            await _send_over(smtp, message)
+    except Exception:
+        smtp.close()  # Reconnected by the next send instead of reused in an unknown state
+        logger.exception("Failed to send verification email")
         raise HTTPException(status_code=500, detail="Failed to send verification email")
     finally:
-        await smtp.quit()
+        pool.put_nowait(smtp)
+
+async def _send_over(smtp: aiosmtplib.SMTP, message: EmailMessage) -> None:
+    if not smtp.is_connected:
+        await smtp.connect()
+        await smtp.login(SMTP_USER, SMTP_PASSWORD)
+    await smtp.send_message(message)
+
+# Logged-in SMTP connections kept open between emails, so a burst of verification codes
+# pays the TCP, TLS and LOGIN handshakes once per connection rather than once per email.
+# A queue rather than one shared client: a connection carries one transaction at a time
+_smtp_pool: Optional[asyncio.Queue] = None
+
+def _get_smtp_pool() -> asyncio.Queue:
+    global _smtp_pool
+    if _smtp_pool is None:
+        _smtp_pool = asyncio.Queue()
+        for _ in range(SMTP_POOL_SIZE):
+            # Connected lazily by the first email sent over each
+            _smtp_pool.put_nowait(aiosmtplib.SMTP(hostname=SMTP_HOST, port=SMTP_PORT, use_tls=False, timeout=10))
+    return _smtp_pool
 
 # Generate verification code
 def generate_verification_code():
-    return secrets.token_hex(3)  # 6 character code
+    return secrets.token_hex(4)  # 8 character code, 2**32 possibilities
 
 # Create access token
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     expire = datetime.utcnow() + (expires_delta or timedelta(minutes=15))
-    to_encode.update({"exp": expire})
-    return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    to_encode.update({"exp": expire, "jti": secrets.token_hex(8)})
+    return jwt.encode(to_encode, _signing_key, algorithm=ALGORITHM)
 
 # Routes
 @router.post("/request-code")
@@ -138,28 +191,39 @@ async def verify_code(verify_data: VerifyCode):
 # OAuth2 scheme for protected routes
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
+# Users of recently verified tokens, so chatty endpoints (position updates on every scroll) skip the
+# signature check and the user query. Keyed on a digest of the whole token rather than its jti: only
+# the exact token that was verified hits, a forged one reusing the jti doesn't.
+_session_cache = ClockCache(SESSION_CACHE_SIZE)  # token digest -> (CurrentUser, expires at)
+# One decoder for every request, refusing tokens without an expiry or a subject
+# (MissingRequiredClaimError is a PyJWTError, so they are a 401 like any other bad token)
+_jwt = jwt.PyJWT(options={"require": ["exp", "sub"]})
+
+def _session_key(session_token: str) -> bytes:
+    return hashlib.blake2b(session_token.encode(), digest_size=16).digest()
+
 # use this for dependency injection
 async def get_current_user(
     session_token: str = Cookie(None)
-) -> User:
+) -> CurrentUser:
     if not session_token:
         raise HTTPException(
             status_code=401,
             detail="Not authenticated"
         )
+
+    key = _session_key(session_token)
+    cached = _session_cache.get(key)
+    if cached is not None and cached[1] > time.time():
+        return cached[0]
     
     try:
-        payload = jwt.decode(
+        payload = _jwt.decode(
             session_token, 
-            SECRET_KEY, 
+            _verifying_key, 
             algorithms=[ALGORITHM]
         )
-        email: str = payload.get("sub")
-        if email is None:
-            raise HTTPException(
-                status_code=401, 
-                detail="Invalid token"
-            )
+        email: str = payload["sub"]
     except jwt.PyJWTError:
         raise HTTPException(
             status_code=401, 
@@ -177,12 +241,15 @@ async def get_current_user(
             status_code=401,
             detail="User not found"
         )
-    return user
+    current_user = CurrentUser(id=user.id, email=user.email, name=user.name)
+    # Never cached past the token's own expiry
+    _session_cache.put(key, (current_user, min(payload["exp"], time.time() + SESSION_CACHE_TTL)))
+    return current_user
 
 # Protected route example
 @router.get("/users/me")
 async def read_users_me(
-    current_user: User = Depends(get_current_user)
+    current_user: CurrentUser = Depends(get_current_user)
 ):
     return current_user
 
@@ -0,0 +1,44 @@
+import threading
+import httpx
+from openai import AsyncOpenAI, OpenAI
+from app.config import OPENAI_API_KEY
+
+# HTTP/2 multiplexes concurrent requests over one connection, but httpx only speaks it with h2 installed
+try:
+    import h2  # noqa: F401
+    HTTP2 = True
+except ImportError:
+    HTTP2 = False
+
+_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=50)
+_TIMEOUT = httpx.Timeout(60.0, connect=5.0)
+
+# One client, and so one connection pool, for the whole process. Concurrent OpenAI requests
+# reuse warm keep-alive connections instead of each caller paying its own TCP/TLS handshakes.
+_async_client = None
+_async_client_lock = threading.Lock()  # Also reached from worker threads via asyncio.to_thread
+_client = None
+_client_lock = threading.Lock()
+
+def get_async_openai_client() -> AsyncOpenAI:
+    global _async_client
+    if _async_client is None:
+        with _async_client_lock:
+            if _async_client is None:
+                _async_client = AsyncOpenAI(
+                    api_key=OPENAI_API_KEY,
+                    http_client=httpx.AsyncClient(http2=HTTP2, limits=_LIMITS, timeout=_TIMEOUT)
+                )
+    return _async_client
+
+def get_openai_client() -> OpenAI:
+    """The sync counterpart, for code still calling OpenAI from worker threads"""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = OpenAI(
+                    api_key=OPENAI_API_KEY,
+                    http_client=httpx.Client(http2=HTTP2, limits=_LIMITS, timeout=_TIMEOUT)
+                )
+    return _client
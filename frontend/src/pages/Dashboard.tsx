@@ -11,6 +11,7 @@ type BookMetadata = {
     page_number: number
     timestamp?: number
   }>
+  ingest_status: 'pending' | 'ready' | 'failed'
 }
 
 export function Dashboard() {